@@ -0,0 +1,265 @@
+""" Maximum clique search """
+
+import itertools
+import time
+import multiprocessing
+
+import numpy as np
+
+
+class MaxClique: #pylint: disable=R0902
+    """ Find the maximum cliques in a graph.
+
+    This is a bitset branch and bound in the style of BBMC. The nodes are
+    renumbered by decreasing degree, and the adjacency rows, candidate sets
+    and color classes are all Python ints used as bitsets. The greedy coloring
+    of the candidates bounds the size of any clique that can be built from them.
+
+    With `processes`, the top-level branches are searched by a process pool
+    whose workers share the size of the largest clique found so far.
+    """
+
+    def __init__(self, edges, verbose=False):
+        edges = np.asarray(edges, bool)
+        self._edges = edges
+        self._order = np.argsort(-edges.sum(axis=1), kind="stable")
+        edges = edges[np.ix_(self._order, self._order)]
+        np.fill_diagonal(edges, False)
+        rows = np.packbits(edges, axis=1, bitorder="little")
+        self._adjacency = [int.from_bytes(row.tobytes(), "little") for row in rows]
+        self._max = []
+        self._max_size = 0
+        self._proven = False
+        self._num_nodes = 0
+        self._shared_size = None
+        self._verbose = verbose
+
+    def _color_candidates(self, candidates, min_color):
+        """ Greedily colors the candidates, returning those with a color of at
+        least `min_color` in coloring order along with their colors """
+        adjacency = self._adjacency
+        nodes = []
+        colors = []
+        color = 0
+        while candidates:
+            color += 1
+            uncolored = candidates
+            while uncolored:
+                bit = uncolored & -uncolored
+                node = bit.bit_length() - 1
+                candidates ^= bit
+                uncolored &= ~adjacency[node]
+                uncolored &= ~bit
+                if color >= min_color:
+                    nodes.append(node)
+                    colors.append(color)
+
+        return nodes, colors
+
+    @property
+    def proven(self):
+        """ Whether the last search finished, so that its cliques are maximum """
+        return self._proven
+
+    @property
+    def num_nodes(self):
+        """ The number of search nodes expanded by the last search """
+        return self._num_nodes
+
+    def find(self, time_limit=None, max_nodes=None, processes=None):
+        """ Finds the maximum cliques.
+
+        The search stops early once `time_limit` seconds have passed or
+        `max_nodes` search nodes have been expanded. It then returns the
+        largest cliques found so far, and `proven` is False. A budget cannot
+        be combined with `processes`.
+        """
+        self._max = []
+        self._max_size = 0
+        if processes is not None:
+            if time_limit is not None or max_nodes is not None:
+                raise ValueError("A budget cannot be used with a process pool")
+
+            self._find_parallel(processes)
+        else:
+            deadline = None if time_limit is None else time.perf_counter() + time_limit
+            self._proven = self._search([], (1 << len(self._adjacency)) - 1, deadline,
+                                        max_nodes)
+
+        return [sorted(int(self._order[node]) for node in clique) for clique in self._max]
+
+    def _find_parallel(self, processes):
+        """ Searches each top-level branch in a process pool, in the order the
+        sequential search would visit them """
+        candidates = (1 << len(self._adjacency)) - 1
+        nodes, colors = self._color_candidates(candidates, 0)
+        branches = []
+        for node, color in zip(reversed(nodes), reversed(colors)):
+            branches.append((node, color, candidates))
+            candidates &= ~(1 << node)
+
+        shared_size = multiprocessing.Value("i", 0)
+        self._num_nodes = 0
+        with multiprocessing.Pool(processes, _init_clique_worker,
+                                  (self._edges, self._verbose, shared_size)) as pool:
+            for cliques, num_nodes in pool.imap(_search_clique_branch, branches):
+                self._num_nodes += num_nodes
+                for clique in cliques:
+                    if len(clique) > self._max_size:
+                        self._max_size = len(clique)
+                        self._max = [clique]
+                    elif len(clique) == self._max_size:
+                        self._max.append(clique)
+
+        self._proven = True
+
+    def _search_branch(self, node, color, candidates, shared_size):
+        """ Searches the cliques containing the node and drawn from the
+        candidates, sharing the incumbent size with the other processes.
+        Returns the cliques found and the number of search nodes. """
+        self._shared_size = shared_size
+        self._max = []
+        self._max_size = shared_size.value
+        self._num_nodes = 0
+        if color < self._max_size:
+            return [], 0
+
+        adjacent = candidates & self._adjacency[node]
+        if adjacent:
+            self._search([node], adjacent)
+        else:
+            self._record([node])
+
+        return self._max, self._num_nodes + 1
+
+    def _record(self, clique):
+        """ Records a clique that cannot be extended """
+        if self._shared_size is not None and self._shared_size.value > self._max_size:
+            self._max_size = self._shared_size.value
+
+        if len(clique) > self._max_size:
+            self._max_size = len(clique)
+            self._max = [clique.copy()]
+            if self._verbose:
+                print("|Qmax| =", self._max_size)
+
+            if self._shared_size is not None:
+                with self._shared_size.get_lock():
+                    if self._shared_size.value < self._max_size:
+                        self._shared_size.value = self._max_size
+        elif len(clique) == self._max_size:
+            self._max.append(clique.copy())
+
+    def _search(self, current, candidates, deadline=None, max_nodes=None):
+        """ Extends the clique with the candidates, using an explicit stack
+        with one [candidates, nodes, colors] frame per clique node. Returns
+        False if the budget ran out before the search finished. """
+        self._num_nodes = 0
+        base = len(current)
+        stack = [[candidates, *self._color_candidates(candidates, self._max_size - base)]]
+        while stack:
+            frame = stack[-1]
+            candidates, nodes, colors = frame
+            if not nodes or len(current) + colors[-1] < self._max_size:
+                stack.pop()
+                if len(current) > base:
+                    stack[-1][0] &= ~(1 << current.pop())
+
+                continue
+
+            if max_nodes is not None and self._num_nodes >= max_nodes:
+                return False
+
+            if deadline is not None and self._num_nodes % 256 == 0 \
+                    and time.perf_counter() > deadline:
+                return False
+
+            node = nodes.pop()
+            colors.pop()
+            self._num_nodes += 1
+
+            current.append(node)
+            adjacent = candidates & self._adjacency[node]
+            if adjacent:
+                if self._shared_size is not None and self._shared_size.value > self._max_size:
+                    self._max_size = self._shared_size.value
+
+                stack.append([adjacent, *self._color_candidates(adjacent,
+                                                                self._max_size - len(current))])
+                continue
+
+            self._record(current)
+            current.pop()
+            frame[0] &= ~(1 << node)
+
+        return True
+
+
+_CLIQUE_WORKER = None
+
+
+def _init_clique_worker(edges, verbose, shared_size):
+    """ Sets up a process pool worker for `MaxClique` """
+    global _CLIQUE_WORKER  # pylint: disable=W0603
+    _CLIQUE_WORKER = (MaxClique(edges, verbose), shared_size)
+
+
+def _search_clique_branch(branch):
+    """ Searches a top-level `MaxClique` branch in a worker """
+    max_clique, shared_size = _CLIQUE_WORKER
+    return max_clique._search_branch(*branch, shared_size)  # pylint: disable=W0212
+
+
+def _brute_force_cliques(edges):
+    """ All maximum cliques of a small graph, by enumeration """
+    nodes = range(len(edges))
+    for size in range(len(edges), 0, -1):
+        cliques = [list(clique) for clique in itertools.combinations(nodes, size)
+                   if all(edges[a, b] for a, b in itertools.combinations(clique, 2))]
+        if cliques:
+            return cliques
+
+    return []
+
+
+def test_max_clique():
+    """ The bitset search should find every maximum clique """
+    rng = np.random.default_rng(2018)
+    for _ in range(100):
+        size = rng.integers(1, 12)
+        edges = rng.random((size, size)) < rng.random()
+        edges = edges | edges.T
+        np.fill_diagonal(edges, False)
+        assert sorted(MaxClique(edges).find()) == _brute_force_cliques(edges)
+
+
+def test_max_clique_budget():
+    """ The search should not recurse, and should stop when its budget runs out """
+    edges = ~np.eye(1200, dtype=bool)
+    max_clique = MaxClique(edges)
+    assert max_clique.find() == [list(range(1200))]
+    assert max_clique.proven
+
+    rng = np.random.default_rng(2018)
+    edges = rng.random((200, 200)) < 0.5
+    edges = edges | edges.T
+    np.fill_diagonal(edges, False)
+    max_clique = MaxClique(edges)
+    cliques = max_clique.find(max_nodes=100)
+    assert not max_clique.proven
+    assert max_clique.num_nodes == 100
+    assert all(edges[a, b] for clique in cliques for a, b in itertools.combinations(clique, 2))
+
+    cliques = max_clique.find(time_limit=0.05)
+    assert not max_clique.proven
+
+
+def test_max_clique_parallel():
+    """ The process pool should find the same cliques as the sequential search """
+    rng = np.random.default_rng(2018)
+    for size, density in [(12, 0.5), (60, 0.7), (80, 0.9)]:
+        edges = rng.random((size, size)) < density
+        edges = edges | edges.T
+        np.fill_diagonal(edges, False)
+        max_clique = MaxClique(edges)
+        assert max_clique.find(processes=2) == max_clique.find()
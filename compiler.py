@@ -0,0 +1,380 @@
+""" Compiles Elf CPU programs to Python functions """
+
+import logging
+from math import isqrt
+
+
+OP_SOURCE = {
+    "addr": "{ra} + {rb}",
+    "addi": "{ra} + {b}",
+    "mulr": "{ra} * {rb}",
+    "muli": "{ra} * {b}",
+    "banr": "{ra} & {rb}",
+    "bani": "{ra} & {b}",
+    "borr": "{ra} | {rb}",
+    "bori": "{ra} | {b}",
+    "setr": "{ra}",
+    "seti": "{a}",
+    "gtir": "1 if {a} > {rb} else 0",
+    "gtri": "1 if {ra} > {b} else 0",
+    "gtrr": "1 if {ra} > {rb} else 0",
+    "eqir": "1 if {a} == {rb} else 0",
+    "eqri": "1 if {ra} == {b} else 0",
+    "eqrr": "1 if {ra} == {rb} else 0"
+}
+
+
+def reads_registers(op_code):
+    """ Whether operands A and B of the op code are registers """
+    template = OP_SOURCE[op_code]
+    return "{ra}" in template, "{rb}" in template
+
+
+def register_ref(index):
+    """ Source reference to a register in a list named `r` """
+    return "r[{}]".format(index)
+
+
+def define_function(lines, name, filename):
+    """ Compiles the lines of Python source and returns the function `name` """
+    namespace = {}
+    exec(compile("\n".join(lines), filename, "exec"), namespace)  # pylint: disable=W0122
+    return namespace[name]
+
+
+def compile_block(instructions, start, binding, stops=()):
+    """ Compiles the basic block starting at `start` into a single function.
+
+    The block runs until the first instruction which writes the bound
+    register, the end of the program or the instruction before one of the
+    `stops`, which always begin their own block. Registers are held in locals, and
+    the bound register is replaced by the constant instruction pointer.
+    Returns the function, which returns the next instruction pointer, and
+    the number of instructions in the block.
+    """
+    loads = set()
+    stores = set()
+    body = []
+
+    def ref(index):
+        # pointer is the loop variable below, i.e. the instruction being compiled
+        if index == binding:
+            return str(pointer)
+
+        if index not in stores:
+            loads.add(index)
+
+        return "r{}".format(index)
+
+    for pointer in range(start, len(instructions)):
+        inst = instructions[pointer]
+        assert inst.op_code != "#ip", "the compiler does not support rebinding #ip"
+        target = inst.args[2]
+        body.append("    r{} = {}".format(target, inst.source(ref)))
+        stores.add(target)
+        if target == binding or pointer + 1 in stops:
+            break
+
+    if binding in stores:
+        next_ip = "r{} + 1".format(binding)
+    else:
+        body.append("    r{} = {}".format(binding, pointer))
+        stores.add(binding)
+        next_ip = str(pointer + 1)
+
+    lines = ["def block(r):"]
+    lines.extend(["    r{0} = r[{0}]".format(index) for index in sorted(loads)])
+    lines.extend(body)
+    lines.extend(["    r[{0}] = r{0}".format(index) for index in sorted(stores)])
+    lines.append("    return " + next_ip)
+    function = define_function(lines, "block", "block_{}".format(start))
+    return function, pointer - start + 1
+
+
+COMMUTATIVE_OPS = set(["addr", "mulr", "banr", "borr", "eqrr"])
+
+
+class LoopIdiom:
+    """ A loop pattern which can be replaced with native Python arithmetic.
+
+    Patterns are lists of instructions whose arguments are tokens:
+        _       matches anything
+        ip      the register bound to the instruction pointer
+        5       the literal value 5
+        @-1     the value start - 1, i.e. a jump target relative to the loop
+        $name   an immediate value, captured as `name`
+        name    a register (other than ip), captured as `name`
+    Distinct register names must match distinct registers.
+    """
+
+    name = None
+    pattern = []
+
+    def match(self, instructions, start, binding):
+        """ Returns the captures if the pattern matches at `start`, otherwise None """
+        if start + len(self.pattern) > len(instructions):
+            return None
+
+        return self._match(instructions, start, binding, 0, {})
+
+    def _match(self, instructions, start, binding, offset, captures):
+        if offset == len(self.pattern):
+            return captures
+
+        inst = instructions[start + offset]
+        op_code, *tokens = self.pattern[offset].split()
+        if inst.op_code != op_code:
+            return None
+
+        orders = [inst.args]
+        if op_code in COMMUTATIVE_OPS:
+            orders.append((inst.args[1], inst.args[0], inst.args[2]))
+
+        for args in orders:
+            matched = dict(captures)
+            if all(self._match_arg(token, value, start, binding, matched)
+                   for token, value in zip(tokens, args)):
+                result = self._match(instructions, start, binding, offset + 1, matched)
+                if result is not None:
+                    return result
+
+        return None
+
+    def _match_arg(self, token, value, start, binding, captures):
+        if token == "_":
+            return True
+
+        fixed = self._fixed_value(token, start, binding)
+        if fixed is not None:
+            return value == fixed
+
+        if token.startswith("$"):
+            return captures.setdefault(token[1:], value) == value
+
+        return self._match_register(token, value, binding, captures)
+
+    @staticmethod
+    def _fixed_value(token, start, binding):
+        """ The value required by an ip, literal or relative token, otherwise None """
+        if token == "ip":
+            return binding
+
+        if token.lstrip("-").isdigit():
+            return int(token)
+
+        if token.startswith("@"):
+            return start + int(token[1:])
+
+        return None
+
+    def _match_register(self, token, value, binding, captures):
+        if token in captures:
+            return captures[token] == value
+
+        immediates = self.immediate_names()
+        registers = [captured for name, captured in captures.items() if name not in immediates]
+        if value == binding or value in registers:
+            return False
+
+        captures[token] = value
+        return True
+
+    def immediate_names(self):
+        """ The names of the $ tokens in the pattern """
+        return set(token[1:] for line in self.pattern for token in line.split()
+                   if token.startswith("$"))
+
+    def exit_ip(self, start, captures):  # pylint: disable=W0613
+        """ The instruction pointer at which execution continues after the loop """
+        return start + len(self.pattern)
+
+    def accepts(self, captures):  # pylint: disable=W0613,R0201
+        """ Whether the captured immediates allow the loop to be replaced """
+        return True
+
+    def apply(self, registers, captures):
+        """ Runs the loop to completion on the registers.
+
+        Returns False (leaving the registers untouched) if the loop cannot
+        be replaced for the current register values.
+        """
+        raise NotImplementedError
+
+
+class DivisorLoop(LoopIdiom):
+    """ for j in j..n: if i*j == n: acc += i """
+
+    name = "divisor loop"
+    pattern = [
+        "mulr i j t",
+        "eqrr t n t",
+        "addr t ip ip",
+        "addi ip 1 ip",
+        "addr i acc acc",
+        "addi j 1 j",
+        "gtrr j n t",
+        "addr ip t ip",
+        "seti @-1 _ ip"
+    ]
+
+    def apply(self, registers, captures):
+        i, j, number = [registers[captures[name]] for name in "ijn"]
+        if i != 0 and number % i == 0 and j <= number // i <= max(j, number):
+            registers[captures["acc"]] += i
+
+        registers[captures["j"]] = max(j, number) + 1
+        registers[captures["t"]] = 1
+        return True
+
+
+class DivisorSum(LoopIdiom):
+    """ for i in i..n: for j in 1..n: if i*j == n: acc += i """
+
+    name = "divisor sum"
+    pattern = [
+        "seti 1 _ j",
+        "mulr i j t",
+        "eqrr t n t",
+        "addr t ip ip",
+        "addi ip 1 ip",
+        "addr i acc acc",
+        "addi j 1 j",
+        "gtrr j n t",
+        "addr ip t ip",
+        "seti @0 _ ip",
+        "addi i 1 i",
+        "gtrr i n t",
+        "addr t ip ip",
+        "seti @-1 _ ip"
+    ]
+
+    def apply(self, registers, captures):
+        i, number = registers[captures["i"]], registers[captures["n"]]
+        if number < 1:
+            return False
+
+        total = 0
+        for factor in range(1, isqrt(number) + 1):
+            if number % factor == 0:
+                for divisor in set([factor, number // factor]):
+                    if divisor >= i:
+                        total += divisor
+
+        registers[captures["acc"]] += total
+        registers[captures["i"]] = max(i, number) + 1
+        registers[captures["j"]] = number + 1
+        registers[captures["t"]] = 1
+        return True
+
+
+class DivideLoop(LoopIdiom):
+    """ q = smallest q >= q such that (q + 1)*k > b, i.e. b // k """
+
+    name = "divide loop"
+    pattern = [
+        "addi q 1 t",
+        "muli t $k t",
+        "gtrr t b t",
+        "addr t ip ip",
+        "addi ip 1 ip",
+        "seti $exit _ ip",
+        "addi q 1 q",
+        "seti @-1 _ ip"
+    ]
+
+    def exit_ip(self, start, captures):
+        return captures["exit"] + 1
+
+    def accepts(self, captures):
+        return captures["k"] > 0
+
+    def apply(self, registers, captures):
+        quotient, b = registers[captures["q"]], registers[captures["b"]]
+        registers[captures["q"]] = max(quotient, b // captures["k"])
+        registers[captures["t"]] = 1
+        return True
+
+
+LOOP_IDIOMS = [DivisorSum(), DivisorLoop(), DivideLoop()]
+
+
+def find_loop_idioms(program, idioms=None):
+    """ Finds the loop idioms in the program.
+
+    Returns a dictionary mapping the loop start to the idiom and its captures.
+    """
+    if idioms is None:
+        idioms = LOOP_IDIOMS
+
+    assert program[0].op_code == "#ip"
+    binding = program[0].args[0]
+    instructions = program[1:]
+    loops = {}
+    for start in range(len(instructions)):
+        for idiom in idioms:
+            captures = idiom.match(instructions, start, binding)
+            if captures is not None and idiom.accepts(captures):
+                logging.debug("found %s at %d: %s", idiom.name, start, captures)
+                loops[start] = idiom, captures
+                break
+
+    return loops
+
+
+def idiom_block(idiom, captures, start, binding, block):
+    """ Wraps the block at the start of a loop so that it runs the idiom instead """
+    exit_ip = idiom.exit_ip(start, captures)
+
+    def run_loop(registers):
+        if idiom.apply(registers, captures):
+            registers[binding] = exit_ip - 1
+            return exit_ip
+
+        return block(registers)
+
+    return run_loop
+
+
+def compile_blocks(program, idioms=(), stops=()):
+    """ Compiles a program into a basic block for every entry point.
+
+    Blocks at the start of a recognized loop idiom run the idiom instead,
+    unless the loop contains one of the `stops`.
+    Returns the ip binding, the block functions and their lengths.
+    """
+    assert program[0].op_code == "#ip"
+    binding = program[0].args[0]
+    instructions = program[1:]
+    loops = find_loop_idioms(program, idioms) if idioms else {}
+    for start, (idiom, _) in list(loops.items()):
+        end = start + len(idiom.pattern)
+        if any(start < stop < end for stop in stops):
+            del loops[start]
+
+    blocks = []
+    lengths = []
+    for start in range(len(instructions)):
+        block, length = compile_block(instructions, start, binding, stops)
+        if start in loops:
+            idiom, captures = loops[start]
+            block = idiom_block(idiom, captures, start, binding, block)
+
+        blocks.append(block)
+        lengths.append(length)
+
+    return binding, blocks, lengths
+
+
+def compile_program(program):
+    """ Compiles a program into a list of specialized per-instruction functions.
+
+    Returns the ip binding and the list of compiled instructions.
+    """
+    assert program[0].op_code == "#ip"
+    binding = program[0].args[0]
+    steps = []
+    for pointer, inst in enumerate(program[1:]):
+        assert inst.op_code != "#ip", "the compiler does not support rebinding #ip"
+        steps.append(inst.compile(pointer, binding))
+
+    return binding, steps
@@ -1,9 +1,16 @@
 """ Implementation of the Elf CPU """
 
 import logging
+import time
 
+import numpy as np
 import pytest
 
+from utils import read_input, IntSet
+from compiler import OP_SOURCE, LOOP_IDIOMS, reads_registers, register_ref, define_function
+from compiler import find_loop_idioms, compile_blocks, compile_program
+from tracing import Profile, TraceBuffer, read_trace
+
 
 def assign(registers, index, value):
     """ Assign a value to the register tuple, returning a new tuple """
@@ -221,67 +228,353 @@ def test(operation, instructions, registers, expected):
     assert actual == expected
 
 
+VECTOR_OPS = {
+    "addr": lambda a, b, ra, rb: ra + rb,
+    "addi": lambda a, b, ra, rb: ra + b,
+    "mulr": lambda a, b, ra, rb: ra * rb,
+    "muli": lambda a, b, ra, rb: ra * b,
+    "banr": lambda a, b, ra, rb: ra & rb,
+    "bani": lambda a, b, ra, rb: ra & b,
+    "borr": lambda a, b, ra, rb: ra | rb,
+    "bori": lambda a, b, ra, rb: ra | b,
+    "setr": lambda a, b, ra, rb: ra,
+    "seti": lambda a, b, ra, rb: a,
+    "gtir": lambda a, b, ra, rb: np.greater(a, rb).astype(np.int64),
+    "gtri": lambda a, b, ra, rb: np.greater(ra, b).astype(np.int64),
+    "gtrr": lambda a, b, ra, rb: np.greater(ra, rb).astype(np.int64),
+    "eqir": lambda a, b, ra, rb: np.equal(a, rb).astype(np.int64),
+    "eqri": lambda a, b, ra, rb: np.equal(ra, b).astype(np.int64),
+    "eqrr": lambda a, b, ra, rb: np.equal(ra, rb).astype(np.int64)
+}
+
+
+RUN_PLAIN = "plain"
+RUN_TRACED = "traced"
+RUN_DEBUG = "debug"
+RUN_PROFILED = "profiled"
+
+
 class CPU:
-    """ CPU Simulator """
+    """ CPU Simulator
+
+    If `trace` is True the steps are recorded in a list; it can also be
+    a `TraceBuffer`.
+    """
 
     def __init__(self, registers=(0, 0, 0, 0, 0, 0), trace=False):
         self._registers = list(registers)
         self._ip = 0
-        if trace:
+        self._profile = None
+        if isinstance(trace, TraceBuffer):
+            self._data = trace
+        elif trace:
             self._data = []
         else:
             self._data = None
 
-    def run_program(self, program, num_steps=None):
-        """ Run a program on the CPU """
-        self._ip = 0
+    def run_program(self, program, num_steps=None, mode=None):
+        """ Run a program on the CPU
+
+        The mode selects the interpreter loop: RUN_PLAIN, RUN_TRACED (which
+        records the trace), RUN_DEBUG (which also logs every step) or
+        RUN_PROFILED (which counts executions per instruction). By
+        default, RUN_DEBUG is used if debug logging is enabled, otherwise
+        RUN_TRACED if the CPU has a trace and RUN_PLAIN if not.
+        """
+        if mode is None:
+            if logging.root.isEnabledFor(logging.DEBUG):
+                mode = RUN_DEBUG
+            elif self._data is not None:
+                mode = RUN_TRACED
+            else:
+                mode = RUN_PLAIN
 
         assert program[0].op_code == "#ip"
         binding = program[0].args[0]
         program = program[1:]
+        limit = num_steps if num_steps else -1
+
+        if mode == RUN_PLAIN:
+            self._run_plain(program, binding, limit)
+        elif mode == RUN_TRACED:
+            assert self._data is not None, "the CPU was created without a trace"
+            self._run_traced(program, binding, limit)
+        elif mode == RUN_DEBUG:
+            self._run_debug(program, binding, limit)
+        elif mode == RUN_PROFILED:
+            self._run_profiled(program, binding, limit)
+        else:
+            raise ValueError("Unknown run mode: " + mode)
 
+    def _run_plain(self, program, binding, limit):
+        registers = self._registers
+        size = len(program)
+        pointer = 0
         step = 0
-        while self._ip < len(program):
-            inst = program[self._ip]
+        while pointer < size and step != limit:
+            inst = program[pointer]
             if inst.op_code == "#ip":
                 binding = inst.args[0]
-                self._ip += 1
+                pointer += 1
                 continue
 
-            if binding is not None:
-                self._registers = assign(self._registers, binding, self._ip)
+            registers[binding] = pointer
+            inst.execute(registers)
+            pointer = registers[binding] + 1
+            step += 1
 
-            if logging.DEBUG >= logging.root.level:
-                before = str(self._registers)
-            else:
-                before = None
+        self._ip = pointer
+
+    def _run_profiled(self, program, binding, limit):
+        registers = self._registers
+        size = len(program)
+        counts = [0] * size
+        pointer = 0
+        step = 0
+        while pointer < size and step != limit:
+            inst = program[pointer]
+            if inst.op_code == "#ip":
+                binding = inst.args[0]
+                pointer += 1
+                continue
+
+            counts[pointer] += 1
+            registers[binding] = pointer
+            inst.execute(registers)
+            pointer = registers[binding] + 1
+            step += 1
+
+        self._ip = pointer
+        self._profile = Profile(program, counts)
 
-            if self._data is not None:
-                self._data.append((self._ip, tuple(self._registers)))
+    def _run_traced(self, program, binding, limit):
+        registers = self._registers
+        data = self._data
+        size = len(program)
+        pointer = 0
+        step = 0
+        while pointer < size and step != limit:
+            inst = program[pointer]
+            if inst.op_code == "#ip":
+                binding = inst.args[0]
+                pointer += 1
+                continue
+
+            registers[binding] = pointer
+            data.append((pointer, tuple(registers)))
+            inst.execute(registers)
+            pointer = registers[binding] + 1
+            step += 1
+
+        self._ip = pointer
+
+    def _run_debug(self, program, binding, limit):
+        registers = self._registers
+        data = self._data
+        size = len(program)
+        pointer = 0
+        step = 0
+        while pointer < size and step != limit:
+            inst = program[pointer]
+            if inst.op_code == "#ip":
+                binding = inst.args[0]
+                pointer += 1
+                continue
+
+            registers[binding] = pointer
+            before = str(registers)
+            if data is not None:
+                data.append((pointer, tuple(registers)))
+
+            inst.execute(registers)
+            logging.debug("ip=%d %s %s %s", pointer, before, inst, registers)
+            pointer = registers[binding] + 1
+            step += 1
 
-            self._registers = inst.execute(self._registers)
-            logging.debug("ip=%d %s %s %s", self._ip, before, inst, self._registers)
+        self._ip = pointer
 
-            if binding is not None:
-                self._ip = self._registers[binding]
+    def run_compiled(self, program, num_steps=None):
+        """ Run a program on the CPU after compiling it to Python functions """
+        binding, steps = compile_program(program)
+        registers = self._registers
+        data = self._data
+        size = len(steps)
+        limit = num_steps if num_steps else -1
 
-            self._ip += 1
+        pointer = 0
+        step = 0
+        if data is None:
+            while 0 <= pointer < size and step != limit:
+                pointer = steps[pointer](registers)
+                step += 1
+        else:
+            while 0 <= pointer < size and step != limit:
+                registers[binding] = pointer
+                data.append((pointer, tuple(registers)))
+                pointer = steps[pointer](registers)
+                step += 1
+
+        self._ip = pointer
+
+    def run_jit(self, program, num_steps=None, recognize_loops=True):
+        """ Run a program on the CPU by compiling each basic block to a Python function.
+
+        Loops matching one of the `LOOP_IDIOMS` are replaced with native Python
+        arithmetic. As they no longer run step by step, loops are only
+        recognized when the number of steps is unbounded. Tracing requires
+        single steps, so traced runs fall back to `run_compiled`.
+        """
+        if self._data is not None:
+            self.run_compiled(program, num_steps)
+            return
+
+        idioms = LOOP_IDIOMS if recognize_loops and not num_steps else ()
+        _, blocks, lengths = compile_blocks(program, idioms)
+        registers = self._registers
+        size = len(blocks)
+
+        pointer = 0
+        if not num_steps:
+            while 0 <= pointer < size:
+                pointer = blocks[pointer](registers)
+
+            self._ip = pointer
+            return
 
+        step = 0
+        while 0 <= pointer < size and step + lengths[pointer] <= num_steps:
+            step += lengths[pointer]
+            pointer = blocks[pointer](registers)
+
+        _, steps = compile_program(program)
+        while 0 <= pointer < size and step < num_steps:
+            pointer = steps[pointer](registers)
             step += 1
-            if num_steps and step >= num_steps:
+
+        self._ip = pointer
+
+    def run_until_repeat(self, program, watch_ip, register):
+        """ Run a program until the watched register repeats a value at `watch_ip`.
+
+        Values are recorded in an `IntSet` each time execution reaches the
+        watched instruction. Returns the first-seen values in order.
+        """
+        _, blocks, _ = compile_blocks(program, LOOP_IDIOMS, [watch_ip])
+        registers = self._registers
+        size = len(blocks)
+        seen = IntSet()
+
+        pointer = 0
+        while 0 <= pointer < size:
+            if pointer == watch_ip and not seen.add(registers[register]):
                 break
 
+            pointer = blocks[pointer](registers)
+
+        self._ip = pointer
+        return seen.values
+
     @property
     def stack(self):
         """ The current values of the CPU's registers """
         return tuple(self._registers)
 
+    @property
+    def profile(self):
+        """ The profile of the last RUN_PROFILED run """
+        return self._profile
+
     @property
     def trace(self):
         """ Returns a trace of the program """
         return self._data
 
 
+class BatchCPU:
+    """ Runs a program from many initial register states in lock-step.
+
+    Each lane is a row of an int64 register array with its own instruction
+    pointer. Every step, the lanes at the same instruction are updated
+    together with `VECTOR_OPS`, and halted lanes are masked out.
+    """
+
+    def __init__(self, registers):
+        self._registers = np.array(registers, np.int64)
+        assert self._registers.ndim == 2
+        self._ips = np.zeros(len(self._registers), np.int64)
+        self._steps = np.zeros(len(self._registers), np.int64)
+        self._size = 0
+
+    def run_program(self, program, num_steps=None):
+        """ Runs the program on every lane until all lanes halt or run `num_steps` """
+        assert program[0].op_code == "#ip"
+        binding = program[0].args[0]
+        program = program[1:]
+        assert all(inst.op_code != "#ip" for inst in program), \
+            "the batch CPU does not support rebinding #ip"
+
+        ips = self._ips
+        steps = self._steps
+        size = self._size = len(program)
+        ips[:] = 0
+        steps[:] = 0
+        while True:
+            active = (ips >= 0) & (ips < size)
+            if num_steps:
+                active &= steps < num_steps
+
+            lanes = np.flatnonzero(active)
+            if len(lanes) == 0:
+                break
+
+            lane_ips = ips[lanes]
+            first, last = lane_ips.min(), lane_ips.max()
+            if first == last:
+                self._execute(program[first], first, binding, lanes)
+            else:
+                for pointer in np.unique(lane_ips).tolist():
+                    self._execute(program[pointer], pointer, binding, lanes[lane_ips == pointer])
+
+            steps[lanes] += 1
+
+    def _execute(self, inst, pointer, binding, lanes):
+        registers = self._registers
+        registers[lanes, binding] = pointer
+        a, b, target = inst.args
+        reads_a, reads_b = reads_registers(inst.op_code)
+        values_a = registers[lanes, a] if reads_a else None
+        values_b = registers[lanes, b] if reads_b else None
+        registers[lanes, target] = VECTOR_OPS[inst.op_code](a, b, values_a, values_b)
+        self._ips[lanes] = registers[lanes, binding] + 1
+
+    @property
+    def stacks(self):
+        """ The registers of every lane """
+        return self._registers
+
+    @property
+    def num_steps(self):
+        """ The number of steps each lane ran """
+        return self._steps
+
+    @property
+    def halted(self):
+        """ Whether each lane's instruction pointer has left the program """
+        return (self._ips < 0) | (self._ips >= self._size)
+
+
+def benchmark_modes(program, num_steps):
+    """ Measures the time per step in nanoseconds of each run mode """
+    results = {}
+    for mode in (RUN_PLAIN, RUN_TRACED, RUN_DEBUG):
+        cpu = CPU(trace=mode != RUN_PLAIN)
+        start = time.perf_counter()
+        cpu.run_program(program, num_steps, mode)
+        results[mode] = (time.perf_counter() - start) * 1e9 / num_steps
+
+    return results
+
+
 class Instruction:
     """ Class representing an instruction in a program """
 
@@ -303,3 +596,193 @@ class Instruction:
     def execute(self, registers):
         """ Execute this instruction """
         return OPS[self.op_code](registers, self.args)
+
+    def source(self, ref=register_ref):
+        """ Python source for the value this instruction assigns to register C """
+        template = OP_SOURCE[self.op_code]
+        a, b, _ = self.args
+        ref_a = ref(a) if "{ra}" in template else None
+        ref_b = ref(b) if "{rb}" in template else None
+        return template.format(a=a, b=b, ra=ref_a, rb=ref_b)
+
+    def compile(self, pointer, binding):
+        """ Compiles this instruction to a function which updates a register list.
+
+        The function writes the instruction pointer to the bound register,
+        executes the instruction and returns the next instruction pointer.
+        """
+        target = self.args[2]
+        lines = ["def step(r):",
+                 "    r[{}] = {}".format(binding, pointer),
+                 "    r[{}] = {}".format(target, self.source())]
+        if target == binding:
+            lines.append("    return r[{}] + 1".format(binding))
+        else:
+            lines.append("    return {}".format(pointer + 1))
+
+        return define_function(lines, "step", repr(self))
+
+
+def benchmark():
+    """ Prints the per-step cost of each run mode on the day 19 program """
+    program = [Instruction(line) for line in read_input(19)]
+    num_steps = 1000000
+    results = benchmark_modes(program, num_steps)
+    for mode in results:
+        print("{}: {:.0f}ns/step".format(mode, results[mode]))
+
+    print("overhead of {} over {}: {:.0f}ns/step".format(
+        RUN_TRACED, RUN_PLAIN, results[RUN_TRACED] - results[RUN_PLAIN]))
+    print("overhead of {} over {}: {:.0f}ns/step".format(
+        RUN_DEBUG, RUN_TRACED, results[RUN_DEBUG] - results[RUN_TRACED]))
+
+
+COMPILED_TESTS = [
+    (19, True, None),
+    (19, False, 100000),
+    (21, False, 100000),
+]
+
+
+@pytest.mark.parametrize("day, test_input, num_steps", COMPILED_TESTS)
+def test_run_compiled(day, test_input, num_steps):
+    """ The compiled CPU should match the interpreter """
+    program = [Instruction(line) for line in read_input(day, test_input)]
+    expected = CPU(trace=True)
+    expected.run_program(program, num_steps)
+    actual = CPU(trace=True)
+    actual.run_compiled(program, num_steps)
+    assert actual.stack == expected.stack
+    assert actual.trace == expected.trace
+
+
+@pytest.mark.parametrize("day, test_input, num_steps", COMPILED_TESTS)
+def test_run_jit(day, test_input, num_steps):
+    """ The basic block JIT should match the interpreter """
+    program = [Instruction(line) for line in read_input(day, test_input)]
+    expected = CPU()
+    expected.run_program(program, num_steps)
+    actual = CPU()
+    actual.run_jit(program, num_steps)
+    assert actual.stack == expected.stack
+
+
+DIVISOR_SUM_PROGRAM = """#ip 1
+seti {} 0 5
+seti {} 0 2
+seti 1 0 4
+mulr 2 4 3
+eqrr 3 5 3
+addr 3 1 1
+addi 1 1 1
+addr 2 0 0
+addi 4 1 4
+gtrr 4 5 3
+addr 1 3 1
+seti 2 0 1
+addi 2 1 2
+gtrr 2 5 3
+addr 3 1 1
+seti 1 0 1"""
+
+DIVIDE_PROGRAM = """#ip 2
+seti {} 0 5
+seti {} 0 1
+addi 1 1 3
+muli 3 256 3
+gtrr 3 5 3
+addr 3 2 2
+addi 2 1 2
+seti 9 0 2
+addi 1 1 1
+seti 1 0 2
+setr 1 0 0"""
+
+# The divisor 5 is also the index of the register holding the dividend
+DIVIDE_BY_REGISTER_INDEX_PROGRAM = DIVIDE_PROGRAM.replace("muli 3 256 3", "muli 3 5 3")
+
+IDIOM_TESTS = [
+    (DIVISOR_SUM_PROGRAM, 36, 1, ["divisor sum", "divisor loop"]),
+    (DIVISOR_SUM_PROGRAM, 97, 5, ["divisor sum", "divisor loop"]),
+    (DIVISOR_SUM_PROGRAM, 1, 3, ["divisor sum", "divisor loop"]),
+    (DIVISOR_SUM_PROGRAM, 0, 1, ["divisor sum", "divisor loop"]),
+    (DIVIDE_PROGRAM, 0, 0, ["divide loop"]),
+    (DIVIDE_PROGRAM, 255, 0, ["divide loop"]),
+    (DIVIDE_PROGRAM, 70000, 0, ["divide loop"]),
+    (DIVIDE_PROGRAM, 70000, 300, ["divide loop"]),
+    (DIVIDE_BY_REGISTER_INDEX_PROGRAM, 70000, 0, ["divide loop"]),
+    (DIVIDE_BY_REGISTER_INDEX_PROGRAM, 4, 0, ["divide loop"]),
+]
+
+
+@pytest.mark.parametrize("text, first, second, expected_idioms", IDIOM_TESTS)
+def test_loop_idioms(text, first, second, expected_idioms):
+    """ Recognized loops should leave the registers as the interpreter does """
+    program = [Instruction(line) for line in text.format(first, second).split("\n")]
+    actual_idioms = [idiom.name for idiom, _ in find_loop_idioms(program).values()]
+    assert actual_idioms == expected_idioms
+
+    expected = CPU()
+    expected.run_program(program)
+    actual = CPU()
+    actual.run_jit(program)
+    assert actual.stack == expected.stack
+
+
+@pytest.mark.parametrize("capacity, path", [(1000, None), (256, "trace_test.bin")])
+def test_trace_buffer(capacity, path, tmp_path):
+    """ The trace buffer should hold the most recent steps of the trace """
+    program = [Instruction(line) for line in read_input(21)]
+    expected = CPU(trace=True)
+    expected.run_program(program, 1000)
+
+    path = str(tmp_path / path) if path else None
+    buffer = TraceBuffer(capacity, path=path, chunk_size=100)
+    actual = CPU(trace=buffer)
+    actual.run_compiled(program, 1000)
+    buffer.close()
+
+    entries = read_trace(path) if path else buffer.entries
+    assert buffer.num_steps == len(expected.trace)
+    assert len(entries) == capacity
+    for (pointer, registers), entry in zip(expected.trace[-capacity:], entries):
+        assert entry["ip"] == pointer
+        assert tuple(entry["registers"]) == registers
+
+
+def test_profile():
+    """ The profile should count the steps the trace records """
+    program = [Instruction(line) for line in read_input(19)]
+    expected = CPU(trace=True)
+    expected.run_program(program, 10000)
+    actual = CPU()
+    actual.run_program(program, 10000, RUN_PROFILED)
+    assert actual.stack == expected.stack
+
+    profile = actual.profile
+    ips = np.array([ip for ip, _ in expected.trace])
+    assert (profile.ip_counts == np.bincount(ips, minlength=len(program) - 1)).all()
+    assert profile.num_steps == 10000
+    assert sum(profile.op_counts.values()) == 10000
+    assert len(profile.listing().split("\n")) > len(program)
+
+
+@pytest.mark.parametrize("day, first_registers, num_steps, halted", [
+    (19, [0, 1], 50000, [False, False]),
+    (21, [0, 1, 12213578, 5310683], 5000, [False, False, True, False]),
+])
+def test_batch_cpu(day, first_registers, num_steps, halted):
+    """ Each lane of the batch CPU should match a CPU run from its registers """
+    program = [Instruction(line) for line in read_input(day)]
+    registers = [(first, 0, 0, 0, 0, 0) for first in first_registers]
+    batch = BatchCPU(registers)
+    batch.run_program(program, num_steps)
+    assert batch.halted.tolist() == halted
+    for lane, lane_registers in enumerate(registers):
+        expected = CPU(lane_registers)
+        expected.run_program(program, num_steps)
+        assert tuple(batch.stacks[lane].tolist()) == expected.stack
+
+
+if __name__ == "__main__":
+    benchmark()
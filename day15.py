@@ -1,12 +1,14 @@
 """ Solution to day 15 of the 2018 Advent of Code """
 
 import logging
+import multiprocessing
 from collections import deque
 from functools import lru_cache
 
 import numpy as np
 
-from utils import read_input, parse_args, ASCIIVideoBuilder, AStarSearch, diff
+from utils import read_input, parse_args, ASCIIVideoBuilder, diff
+from search import grid_bfs
 
 PART1_TEST_OUTCOMES = [
     27730,
@@ -48,12 +50,6 @@ class ElfException(Exception):
     def __init__(self):
         super().__init__("Elf Exception")
 
-@lru_cache(maxsize=4096)
-def heuristic(first, second):
-    """ Manhattan distance heuristic for A-star search """
-    return abs(first[0]-second[0]) + abs(first[1]-second[1])
-
-
 @lru_cache(maxsize=4096)
 def neighbors(point):
     """ Return the manhattan neighbors of a point """
@@ -67,21 +63,24 @@ def neighbors(point):
 
 
 class Unit:
-    """ Class representing a unit in the battle """
+    """ A unit in the battle, which is a view onto the battle's unit arrays """
 
-    def __init__(self, race, battle, index,
-                 health=DEFAULT_HEALTH, attack=DEFAULT_ATTACK):
-        self._race = race
+    def __init__(self, battle, unit_id):
         self._battle = battle
-        self._enemy = GOBLIN if race == ELF else ELF
-        self._health_points = health
-        self._attack_power = attack
-        self._index = index
+        self._id = unit_id
+        self._race = int(battle.races[unit_id])
+        self._enemy = GOBLIN if self._race == ELF else ELF
+        self._attack_power = int(battle.attack_powers[unit_id])
+
+    @property
+    def unit_id(self):
+        """ The unit's position in the battle's unit arrays """
+        return self._id
 
     @property
     def health_points(self):
         """ The health points of the unit """
-        return self._health_points
+        return int(self._battle.health_points[self._id])
 
     @property
     def race(self):
@@ -91,21 +90,21 @@ class Unit:
     @property
     def index(self):
         """ The location of the unit in the battle """
-        return self._index
+        return self._battle.location(self._id)
 
     def take_damage(self, damage):
         """ Causes the unit to take damage, possibly resulting in death """
-        self._health_points -= damage
-        if self._health_points <= 0:
+        self._battle.health_points[self._id] -= damage
+        if self.health_points <= 0:
             self._battle.remove(self)
 
     def __lt__(self, other):
-        return self._index < other.index
+        return self.index < other.index
 
     def _attack(self):
         min_hp = DEFAULT_HEALTH
         targets = []
-        for neighbor in neighbors(self._index):
+        for neighbor in neighbors(self.index):
             other = self._battle[neighbor]
             if other is None or other.race == self._race:
                 continue
@@ -121,33 +120,24 @@ class Unit:
             targets[0].take_damage(self._attack_power)
 
     def find_best_move(self, goals):
-        """ Find the best move given the provided goal squares """
-        min_moves = []
-        min_dist = self._battle.max_dist
-        goals = [(heuristic(self._index, goal), goal) for goal in goals]
-        possible_moves = list(filter(self._battle.is_clear,
-                                     neighbors(self._index)))
-        goals.sort()
-        for dist, goal in goals:
-            if dist > min_dist:
-                continue
-
-            for neighbor in possible_moves:
-                path = self._battle.find_min_path(neighbor, goal)
-                if path is None:
-                    continue
-
-                if len(path) < min_dist:
-                    min_dist = len(path)
-                    min_moves = [neighbor]
-                elif len(path) == min_dist:
-                    min_moves.append(neighbor)
-
-        if not min_moves:
+        """ Find the best move given the provided goal squares.
+
+        The nearest reachable goal is chosen (first in reading order on a
+        tie), and then the first step in reading order on a shortest path to it.
+        """
+        index = self.index
+        distances = self._battle.find_distances(index)
+        reachable = [(distances[goal], goal) for goal in goals if distances[goal] > 0]
+        if not reachable:
             return None
 
-        min_moves.sort()
-        return min_moves[0]
+        min_dist, target = min(reachable)
+        distances = self._battle.find_distances(target)
+        for neighbor in neighbors(index):
+            if distances[neighbor] == min_dist - 1 and self._battle.is_clear(neighbor):
+                return neighbor
+
+        return None
 
     def _move(self, goals):
         best_move = self.find_best_move(goals)
@@ -155,8 +145,7 @@ class Unit:
         if best_move is None:
             return
 
-        if self._battle.move(self, best_move):
-            self._index = best_move
+        self._battle.move(self, best_move)
 
     def take_turn(self):
         """ Causes the unit to take its turn """
@@ -164,12 +153,12 @@ class Unit:
         if not in_range:
             return True
 
-        if self._index in in_range:
+        if self.index in in_range:
             self._attack()
         else:
             valid_goals = list(filter(self._battle.is_clear, in_range))
             self._move(valid_goals)
-            if self._index in in_range:
+            if self.index in in_range:
                 self._attack()
 
         return False
@@ -180,11 +169,18 @@ class Unit:
         return self.health_points > 0
 
     def __repr__(self):
-        return "{}({})".format(chr(self._race), self._health_points)
+        return "{}({})".format(chr(self._race), self.health_points)
 
 
 class Battle: #pylint: disable=R0902
-    """ Class representing a battle simulation """
+    """ Class representing a battle simulation.
+
+    The units are stored as parallel arrays indexed by unit id (flat
+    position, race, health points and attack power), along with a grid
+    holding the id of the unit on each square (-1 if there is none).
+    For each race, the number of its units adjacent to each open square is
+    kept up to date as units move and die.
+    """
 
     def __init__(self, lines,
                  elf_attack_power=DEFAULT_ATTACK,
@@ -194,19 +190,20 @@ class Battle: #pylint: disable=R0902
         lines = np.array(lines)
 
         self._num_rounds = 0
-        self._max_dist = np.prod(lines.shape)
         self._walls = lines == WALL
-        self._units = np.zeros(lines.shape, np.dtype(Unit))
         self._raise_on_elf_death = raise_on_elf_death
-        self._search = AStarSearch(heuristic, lambda a, b: 1, self)
-        for ravel, spec in enumerate(lines.flatten()):
-            index = np.unravel_index(ravel, lines.shape)
-            if spec not in (ELF, GOBLIN):
-                self._units[index] = None
-            else:
-                attack_power = elf_attack_power if spec == ELF else DEFAULT_ATTACK
-                self._units[index] = Unit(
-                    spec, self, index, attack=attack_power)
+
+        self._width = lines.shape[1]
+        self._positions = np.flatnonzero((lines == ELF) | (lines == GOBLIN))
+        self._races = lines.ravel()[self._positions]
+        self._health_points = np.full(len(self._positions), DEFAULT_HEALTH, np.int64)
+        self._attack_powers = np.where(self._races == ELF, elf_attack_power, DEFAULT_ATTACK)
+        self._occupancy = np.full(lines.shape, -1, np.int64)
+        self._occupancy.ravel()[self._positions] = np.arange(len(self._positions))
+        self._units = [Unit(self, unit_id) for unit_id in range(len(self._positions))]
+        self._in_range = {ELF: {}, GOBLIN: {}}
+        for unit_id in range(len(self._positions)):
+            self._update_in_range(int(self._races[unit_id]), self.location(unit_id), 1)
 
         if build_video:
             self._builder = ASCIIVideoBuilder("day15.mp4", self._walls, COLOR_MAP)
@@ -218,12 +215,13 @@ class Battle: #pylint: disable=R0902
     def to_string(self, omit_health=False):
         """ Converts the battle to a string representation """
         lines = []
-        for wall_row, unit_row in zip(self._walls, self._units):
+        for wall_row, id_row in zip(self._walls, self._occupancy):
             blocks = [chr(WALL) if wall else chr(CLEAR) for wall in wall_row]
 
             units = []
-            for col, unit in enumerate(unit_row):
-                if unit:
+            for col, unit_id in enumerate(id_row):
+                if unit_id >= 0:
+                    unit = self._units[unit_id]
                     blocks[col] = chr(unit.race)
                     units.append(str(unit))
 
@@ -236,84 +234,91 @@ class Battle: #pylint: disable=R0902
 
         return "\n".join(lines)
 
-    def neighbors(self, position):
-        """ Returns the valid neighbors for a position """
-        for neighbor in neighbors(position):
-            if self._walls[neighbor]:
-                continue
-
-            if self._units[neighbor]:
-                continue
-
-            yield neighbor
-
-    @property
-    def max_dist(self):
-        """ The maximum distance any unit can be from another """
-        return self._max_dist
-
     @property
     def num_rounds(self):
         """ The number of complete rounds in the battle """
         return self._num_rounds
 
-    def find_in_range(self, race):
-        """ Finds all spots adjacent to units of the provided race """
-        in_range = set()
-        for index, unit in enumerate(self._units.flatten()):
-            if unit is None or unit.race != race:
-                continue
+    @property
+    def races(self):
+        """ The race of each unit """
+        return self._races
 
-            point = np.unravel_index(index, self._units.shape)
+    @property
+    def health_points(self):
+        """ The health points of each unit """
+        return self._health_points
 
-            for neighbor in neighbors(point):
-                if not self._walls[neighbor]:
-                    in_range.add(neighbor)
+    @property
+    def attack_powers(self):
+        """ The attack power of each unit """
+        return self._attack_powers
+
+    def location(self, unit_id):
+        """ The (row, col) location of a unit """
+        return divmod(int(self._positions[unit_id]), self._width)
+
+    def _alive(self):
+        """ The ids of the living units in turn (reading) order """
+        alive = np.flatnonzero(self._health_points > 0)
+        return alive[np.argsort(self._positions[alive], kind="stable")]
+
+    def _update_in_range(self, race, index, delta):
+        """ Adds delta to the in range counts of the race around the index """
+        counts = self._in_range[race]
+        for neighbor in neighbors(index):
+            if self._walls[neighbor]:
+                continue
 
-        return in_range
+            count = counts.get(neighbor, 0) + delta
+            if count:
+                counts[neighbor] = count
+            else:
+                del counts[neighbor]
 
-    def find_min_path(self, start, goal):
-        """ Finds the minimum path from the start to the goal """
-        return self._search.find_shortest_path(start, goal)
+    def find_in_range(self, race):
+        """ Returns a live view of all spots adjacent to units of the provided race """
+        return self._in_range[race].keys()
+
+    def find_distances(self, start):
+        """ Finds the distances from the start to every clear space (-1 if unreachable) """
+        clear = ~self._walls & (self._occupancy < 0)
+        return grid_bfs(clear, [start]).distances
 
     def __repr__(self):
         return self.to_string()
 
     def is_clear(self, index):
         """ Returns whether the provided index is a clear space """
-        if self._walls[index] or self._units[index] is not None:
-            return False
-
-        return True
+        return not self._walls[index] and self._occupancy[index] < 0
 
     def move(self, unit, index):
-        """ Attempts to move the unit to the provided index """
-        assert self._units[unit.index] == unit
-        assert self._units[index] is None
-        self._units[unit.index] = None
-        self._units[index] = unit
-
-        return True
+        """ Moves the unit to the provided index """
+        assert self._occupancy[unit.index] == unit.unit_id
+        assert self._occupancy[index] < 0
+        self._update_in_range(unit.race, unit.index, -1)
+        self._update_in_range(unit.race, index, 1)
+        self._occupancy[unit.index] = -1
+        self._occupancy[index] = unit.unit_id
+        self._positions[unit.unit_id] = index[0] * self._width + index[1]
 
     def remove(self, unit):
         """ Removes the unit from the battle """
-        self._units[unit.index] = None
+        self._update_in_range(unit.race, unit.index, -1)
+        self._occupancy[unit.index] = -1
         if unit.race == ELF:
             if self._raise_on_elf_death:
                 raise ElfException
 
     def __getitem__(self, key):
-        return self._units[key]
+        unit_id = self._occupancy[key]
+        return self._units[unit_id] if unit_id >= 0 else None
 
     def _add_frame(self):
         self._state[self._walls == 1] = WALL
         self._state[self._walls == 0] = CLEAR
-        for unit in self._units.flatten():
-            if unit is None or not unit.is_alive:
-                continue
-
-            self._state[unit.index] = unit.race
-
+        alive = self._alive()
+        self._state.ravel()[self._positions[alive]] = self._races[alive]
         self._builder.add_frame(self._state)
 
     def round(self):
@@ -321,18 +326,15 @@ class Battle: #pylint: disable=R0902
         if self._builder:
             self._add_frame()
 
-        units = self._units.flatten().tolist()
-        for i, unit in enumerate(units):
-            if unit is None or not unit.is_alive:
+        for unit_id in self._alive().tolist():
+            unit = self._units[unit_id]
+            if not unit.is_alive:
                 continue
 
             if self._builder:
                 self._state[unit.index] = unit.race
 
             if unit.take_turn():
-                if i == len(units) - 1:
-                    self._num_rounds += 1
-
                 if self._builder:
                     self._add_frame()
                     self._builder.close()
@@ -345,20 +347,12 @@ class Battle: #pylint: disable=R0902
     @property
     def winners(self):
         """ Returns the winning race the sum of their health points """
-        race = None
-        hp_sum = 0
-        for unit in self._units.flatten():
-            if unit is None or not unit.is_alive:
-                continue
-
-            if unit.race == ELF:
-                race = "Elves"
-            else:
-                race = "Goblins"
-
-            hp_sum += unit.health_points
+        alive = self._alive()
+        if alive.size == 0:
+            return None, 0
 
-        return race, hp_sum
+        race = "Elves" if self._races[alive[0]] == ELF else "Goblins"
+        return race, int(self._health_points[alive].sum())
 
 
 def read_start_state(lines):
@@ -447,23 +441,111 @@ def try_attack_power(expected, attack_power):
         return None
 
 
-def find_attack_power():
-    """ Find an attack power so that the elves win """
+@lru_cache(maxsize=None)
+def attack_power_outcome(expected, attack_power):
+    """ The outcome of the battle if no elf dies at this attack power, otherwise None.
+    Results are cached, so repeated queries do not rerun the battle. """
+    battle = try_attack_power(expected, attack_power)
+    if battle is None:
+        return None
+
+    _, hp_sum = battle.winners
+    return hp_sum * battle.num_rounds
+
+
+def search_attack_power(expected, min_attack_power=4):
+    """ Finds the smallest attack power where no elf dies, with its outcome.
+
+    Assuming that more attack power never gets an elf killed, the power is
+    doubled past the lowest failure until the elves win, and then the last
+    gap is bisected. Each battle stops as soon as an elf dies.
+    """
+    low = min_attack_power
+    high = min_attack_power
+    step = 1
+    while attack_power_outcome(expected, high) is None:
+        logging.debug("%d failed, trying %d", high, high + step)
+        low = high + 1
+        high += step
+        step *= 2
+
+    while low < high:
+        middle = (low + high) // 2
+        if attack_power_outcome(expected, middle) is None:
+            low = middle + 1
+        else:
+            high = middle
+
+    return high, attack_power_outcome(expected, high)
+
+
+_SWEEP_WORKER = None
+
+
+def _init_sweep_worker(expected, best_attack_power):
+    """ Sets up a process pool worker for `sweep_attack_power` """
+    global _SWEEP_WORKER  # pylint: disable=W0603
+    _SWEEP_WORKER = (expected, best_attack_power)
+
+
+def _sweep_battle(attack_power):
+    """ The outcome of the battle at the attack power in a worker, or None if
+    an elf dies or a lower attack power has already won """
+    expected, best_attack_power = _SWEEP_WORKER
+    battle = Battle(expected.split('\n'), attack_power, True)
+    try:
+        while not battle.round():
+            if best_attack_power.value < attack_power:
+                return None
+    except ElfException:
+        return None
+
+    with best_attack_power.get_lock():
+        best_attack_power.value = min(best_attack_power.value, attack_power)
+
+    _, hp_sum = battle.winners
+    return hp_sum * battle.num_rounds
+
+
+def sweep_attack_power(expected, processes=None, min_attack_power=4):
+    """ Finds the smallest attack power where no elf dies, with its outcome.
+
+    A window of consecutive attack powers is fought at once in a process
+    pool. Results are taken in order of attack power, so the first win is
+    the smallest. A win is shared with the workers, which then abandon the
+    battles for higher attack powers, and no higher powers are started.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    best_attack_power = multiprocessing.Value("i", np.iinfo(np.int32).max)
+    with multiprocessing.Pool(processes, _init_sweep_worker,
+                              (expected, best_attack_power)) as pool:
+        pending = {}
+        attack_power = min_attack_power
+        while True:
+            while len(pending) < processes and attack_power < best_attack_power.value:
+                pending[attack_power] = pool.apply_async(_sweep_battle, (attack_power,))
+                attack_power += 1
+
+            lowest = min(pending)
+            outcome = pending.pop(lowest).get()
+            if outcome is not None:
+                return lowest, outcome
+
+            logging.debug("%d failed", lowest)
+
+
+def find_attack_power(processes=None):
+    """ Find an attack power so that the elves win, sweeping with a process
+    pool if `processes` is given """
     lines = deque(read_input(15))
 
     expected = read_start_state(lines)
-    attack_power = 4
-    while True:
-        battle = try_attack_power(expected, attack_power)
-        if battle is None:
-            logging.debug("%d failed, trying %d",
-                          attack_power, attack_power + 1)
+    if processes:
+        _, outcome = sweep_attack_power(expected, processes)
+    else:
+        _, outcome = search_attack_power(expected)
 
-            attack_power += 1
-            continue
-
-        _, hp_sum = battle.winners
-        return hp_sum * battle.num_rounds
+    return outcome
 
 
 def test_part2():
@@ -476,24 +558,18 @@ def test_part2():
         expected = read_start_state(lines)
         read_end_state(lines)
 
-        attack_power = 4
-        while True:
-            battle = try_attack_power(expected, attack_power)
-            if battle is None:
-                logging.debug("%d failed, trying %d",
-                              attack_power, attack_power + 1)
+        assert search_attack_power(expected) == outcomes1[case]
+        case += 1
 
-                attack_power += 1
-                continue
 
-            _, hp_sum = battle.winners
-            expected_ap, expected = outcomes1[case]
-            actual = hp_sum * battle.num_rounds
-            assert attack_power == expected_ap
-            assert actual == expected
-            break
+def test_sweep_attack_power():
+    """ The process pool sweep should find the same attack powers """
+    lines = deque(read_input(15, True))
+    for outcome in PART2_TEST_OUTCOMES:
+        expected = read_start_state(lines)
+        read_end_state(lines)
 
-        case += 1
+        assert sweep_attack_power(expected, 2) == outcome
 
 
 def day15():
@@ -507,7 +583,7 @@ def day15():
         return
 
     print("Part 2")
-    print(find_attack_power())
+    print(find_attack_power(args.processes))
 
 
 if __name__ == "__main__":
@@ -3,8 +3,16 @@
 import logging
 from collections import deque, namedtuple
 
+import numpy as np
+
 from utils import read_input, parse_args
-from cpu import OPS
+from cpu import OPS, VECTOR_OPS, reads_registers
+
+EXAMPLE = [
+    "Before: [3, 2, 1, 1]",
+    "9 2 1 2",
+    "After:  [3, 2, 2, 1]"
+]
 
 
 def read_registers(line):
@@ -49,48 +57,166 @@ class Sample(namedtuple("Sample", ("index", "before", "args", "after"))):
         return matches
 
 
+def read_samples(lines):
+    """ Reads samples from the lines until the program is reached """
+    samples = []
+    while lines[0].startswith("Before:"):
+        sample = Sample.parse([
+            lines.popleft(),
+            lines.popleft(),
+            lines.popleft()
+        ])
+
+        lines.popleft()
+
+        samples.append(sample)
+
+    return samples
+
+
+def read_operand(before, operand):
+    """ The register values an operand names, and whether it names a register """
+    valid = operand < before.shape[1]
+    return before[np.arange(len(before)), np.where(valid, operand, 0)], valid
+
+
+def read_result(before, after, target):
+    """ The value written to register C, and whether no other register changed """
+    num_registers = before.shape[1]
+    valid = target < num_registers
+    index = np.where(valid, target, 0)
+    others_unchanged = np.all((before == after) | (np.arange(num_registers) == index[:, None]),
+                              axis=1)
+    return after[np.arange(len(after)), index], valid & others_unchanged
+
+
+def mask_operands(code, valid, a_valid, b_valid):
+    """ Masks out the samples whose register operands for the op are out of range """
+    reads_a, reads_b = reads_registers(code)
+    if reads_a:
+        valid = valid & a_valid
+
+    if reads_b:
+        valid = valid & b_valid
+
+    return valid
+
+
+def find_match_matrix(samples):
+    """ Evaluates all operations on all samples at once.
+
+    Returns a (samples x ops) boolean matrix of which operations match,
+    with the ops in the order of `OPS`.
+    """
+    before = np.array([sample.before for sample in samples], np.int64)
+    after = np.array([sample.after for sample in samples], np.int64)
+    a, b, target = np.array([sample.args for sample in samples], np.int64).T
+    values_a, a_valid = read_operand(before, a)
+    values_b, b_valid = read_operand(before, b)
+    expected, valid = read_result(before, after, target)
+
+    matches = np.zeros((len(samples), len(OPS)), bool)
+    for i, code in enumerate(OPS):
+        matches[:, i] = (mask_operands(code, valid, a_valid, b_valid)
+                         & (VECTOR_OPS[code](a, b, values_a, values_b) == expected))
+
+    return matches
+
+
 def part1(samples):
     """ Solution to part 1 """
-    num_matches = 0
-    for sample in samples:
-        matches = sample.find_matching_ops()
-        if len(matches) >= 3:
-            num_matches += 1
+    matches = find_match_matrix(samples)
+    return int(np.sum(matches.sum(axis=1) >= 3))
+
+
+ALL_OPS = (1 << len(OPS)) - 1
+
+
+def count_bits(mask):
+    """ The number of set bits in the mask """
+    return bin(mask).count("1")
 
-    return num_matches
+
+def find_domains(samples):
+    """ Finds the candidate ops for each op code number as bitmasks.
+
+    Bit i of a domain is set if op i of `OPS` matches every sample with
+    that number. Numbers without samples can be any op.
+    """
+    matches = find_match_matrix(samples)
+    masks = matches.astype(np.int64) @ (1 << np.arange(len(OPS), dtype=np.int64))
+    indices = np.array([sample.index for sample in samples])
+    domains = [ALL_OPS] * len(OPS)
+    for number in np.unique(indices).tolist():
+        domains[number] = int(np.bitwise_and.reduce(masks[indices == number]))
+
+    return domains
+
+
+def propagate(domains):
+    """ Removes assigned ops from other domains and assigns ops with only one
+    possible number, until nothing changes. Returns None on a contradiction.
+    """
+    domains = list(domains)
+    changed = True
+    while changed:
+        changed = False
+        for number, mask in enumerate(domains):
+            if mask == 0:
+                return None
+
+            if mask & (mask - 1) == 0:
+                for other, other_mask in enumerate(domains):
+                    if other != number and other_mask & mask:
+                        domains[other] = other_mask & ~mask
+                        changed = True
+
+        for bit in range(len(OPS)):
+            op_mask = 1 << bit
+            numbers = [number for number, mask in enumerate(domains) if mask & op_mask]
+            if not numbers:
+                return None
+
+            if len(numbers) == 1 and domains[numbers[0]] != op_mask:
+                domains[numbers[0]] = op_mask
+                changed = True
+
+    return domains
+
+
+def solve_domains(domains):
+    """ Assigns a distinct op to each number, backtracking when propagation stalls.
+    Returns None if there is no solution.
+    """
+    domains = propagate(domains)
+    if domains is None:
+        return None
+
+    unsolved = [number for number, mask in enumerate(domains) if count_bits(mask) > 1]
+    if not unsolved:
+        return domains
+
+    number = min(unsolved, key=lambda number: count_bits(domains[number]))
+    for bit in range(len(OPS)):
+        if domains[number] & (1 << bit):
+            trial = list(domains)
+            trial[number] = 1 << bit
+            logging.debug("guessing %d for %d", bit, number)
+            result = solve_domains(trial)
+            if result is not None:
+                return result
+
+    return None
 
 
 def determine_op_codes(samples):
     """ Determine the correct sequence of op codes using the samples """
-    op_indices = {}
-    for code in OPS:
-        op_indices[code] = set()
-
-    for sample in samples:
-        matches = sample.find_matching_ops()
-        for match in matches:
-            op_indices[match].add(sample.index)
-
-    op_lookup = {}
-    while op_indices:
-        to_clear = []
-        for code in op_indices:
-            if len(op_indices[code]) == 1:
-                op_lookup[code] = op_indices[code].pop()
-                to_clear.append(code)
-
-        for code in to_clear:
-            del op_indices[code]
-            index = op_lookup[code]
-            for other_code in op_indices:
-                if index in op_indices[other_code]:
-                    op_indices[other_code].remove(index)
-
-        logging.debug("%s %s", op_lookup, op_indices)
-
-    op_codes = [""] * len(OPS)
-    for code in op_lookup:
-        op_codes[op_lookup[code]] = code
+    domains = solve_domains(find_domains(samples))
+    if domains is None:
+        raise ValueError("The samples are inconsistent")
+
+    codes = list(OPS)
+    op_codes = [codes[mask.bit_length() - 1] for mask in domains]
 
     logging.debug(op_codes)
 
@@ -108,22 +234,43 @@ def part2(samples, program):
     return registers[0]
 
 
+def test_day16():
+    """ Test for day 16 """
+    sample = Sample.parse(EXAMPLE)
+    expected = ["addi", "mulr", "seti"]
+    actual = sorted(sample.find_matching_ops())
+    assert actual == expected
+
+    matches = find_match_matrix([sample])
+    actual = sorted(code for code, match in zip(OPS, matches[0]) if match)
+    assert actual == expected
+
+    samples = read_samples(deque(read_input(16)))
+    matches = find_match_matrix(samples)
+    for sample, row in zip(samples, matches):
+        expected = sample.find_matching_ops()
+        actual = [code for code, match in zip(OPS, row) if match]
+        assert actual == expected
+
+
+def test_solve_domains():
+    """ Test the solver on domains without a singleton """
+    domains = [1 << number for number in range(len(OPS))]
+    domains[0] = domains[1] = domains[2] = 0b111
+    actual = solve_domains(domains)
+    assert sorted(actual) == [1 << number for number in range(len(OPS))]
+    assert all(mask & domain for mask, domain in zip(actual, domains))
+
+    domains[3] = 0b111
+    assert solve_domains(domains) is None
+
+
 def day16():
     """ Solution to day 16 """
     parse_args()
 
-    samples = []
     lines = deque(read_input(16))
-    while lines[0].startswith("Before:"):
-        sample = Sample.parse([
-            lines.popleft(),
-            lines.popleft(),
-            lines.popleft()
-        ])
-
-        lines.popleft()
-
-        samples.append(sample)
+    samples = read_samples(lines)
 
     print("Part 1")
     print(part1(samples))
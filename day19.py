@@ -6,10 +6,10 @@ from utils import read_input, parse_args
 from cpu import CPU, Instruction
 
 
-def simulate(program):
+def simulate(program, longer_version=False):
     """ Simulate the CPU on the instruction stack """
-    cpu = CPU()
-    cpu.run_program(program)
+    cpu = CPU((1 if longer_version else 0, 0, 0, 0, 0, 0))
+    cpu.run_jit(program)
     return cpu.stack[0]
 
 
@@ -55,7 +55,9 @@ def day19():
     print("Simulation:", expected, "Decompiled:", actual)
 
     print("Part 2")
-    print("Decompiled:", decompiled(True))
+    expected = simulate(program, True)
+    actual = decompiled(True)
+    print("Simulation:", expected, "Decompiled:", actual)
 
 
 if __name__ == "__main__":
@@ -2,7 +2,8 @@
 
 import logging
 
-from utils import parse_args
+from utils import read_input, parse_args
+from cpu import CPU, Instruction
 
 
 def decompiled(num_checks):
@@ -36,17 +37,46 @@ def decompiled(num_checks):
     return checks
 
 
+def find_check(program):
+    """ Finds the instruction which compares a register against register 0 """
+    for pointer, inst in enumerate(program[1:]):
+        if inst.op_code == "eqrr" and 0 in inst.args[:2]:
+            first, second, _ = inst.args
+            return pointer, second if first == 0 else first
+
+    raise ValueError("No check against register 0")
+
+
+def simulate(program):
+    """ Simulate the CPU until the checked values repeat """
+    watch_ip, register = find_check(program)
+    cpu = CPU()
+    return cpu.run_until_repeat(program, watch_ip, register).tolist()
+
+
+def test_day21():
+    """ Test for day 21 """
+    lines = read_input(21)
+    program = [Instruction(line) for line in lines]
+
+    expected = decompiled(None)
+    actual = simulate(program)
+    assert actual == expected
+
+
 def day21():
     """ Solution to day 21 """
     parse_args()
 
+    lines = read_input(21)
+    program = [Instruction(line.strip()) for line in lines]
+    checks = simulate(program)
+
     print("Part 1")
-    checks = decompiled(1)
-    print(checks[0])
+    print("Simulation:", checks[0], "Decompiled:", decompiled(1)[0])
 
     print("Part 2")
-    checks = decompiled(None)
-    print(checks[-1])
+    print("Simulation:", checks[-1], "Decompiled:", decompiled(None)[-1])
 
 
 if __name__ == "__main__":
@@ -4,7 +4,9 @@ from collections import namedtuple
 
 import numpy as np
 
-from utils import parse_args, read_input, diff, AStarSearch
+from utils import parse_args, read_input, diff, benchmark
+from search import AStarSearch, BidirectionalSearch
+from queues import PriorityQueue, LazyPriorityQueue, BucketQueue
 
 DEBUG = (510, (10, 10))
 INPUT = (11991, (6, 797))
@@ -28,6 +30,7 @@ TOOLS = [
 ]
 
 TOOL_SWITCH = 7
+PADDING = 64
 
 
 def distance_between(pos0, pos1):
@@ -105,6 +108,11 @@ class Cave:
         self._erosion_levels[(0, 0)] = depth % MODULO
         self._erosion_levels[target] = depth % MODULO
 
+    @property
+    def target(self):
+        """ The (row, col) location of the target """
+        return self._target
+
     def get_erosion_level(self, row, col):
         """ Returns the erosion level at (row col) """
         return self._compute_erosion(row, col)
@@ -147,15 +155,109 @@ class Cave:
         """ Returns the valid neighbors of a position """
         return position.neighbors(self)
 
-    def find_shortest_path(self):
-        """ Finds the shortest path to the target """
+    def find_shortest_path(self, queue_type=BucketQueue, bidirectional=False, callback=None,
+                           packed=False):
+        """ Finds the shortest path to the target, passing the search statistics to the callback """
         goal = Position(self._target[0], self._target[1], ROCKY, TORCH)
         start = Position(0, 0, ROCKY, TORCH)
 
-        search = AStarSearch(heuristic, distance_between, self)
+        if packed:
+            padding = PADDING
+            while True:
+                packed_cave = PackedCave(self, padding)
+                path = packed_cave.find_shortest_path(start, goal, queue_type, callback)
+                required = packed_cave.required_padding(path)
+                if required <= padding:
+                    return path
+
+                padding = required
+
+        if bidirectional:
+            search = BidirectionalSearch(heuristic, distance_between, self, queue_type, callback)
+        else:
+            search = AStarSearch(heuristic, distance_between, self, queue_type, consistent=True,
+                                 callback=callback)
+
         return search.find_shortest_path(start, goal)
 
 
+class PackedCave:
+    """ The cave as a graph of packed integer states (row*cols + col)*3 + tool.
+
+    The cave is unbounded, so the states are limited to the target's
+    rectangle plus `padding` rows and columns. A path that leaves the
+    rectangle has to travel out to its edge and back, so a path found inside
+    it is only the shortest if no such detour is cheaper.
+    """
+
+    def __init__(self, cave, padding=PADDING):
+        target_row, target_col = cave.target
+        self._target = cave.target
+        self._rows = target_row + padding + 1
+        self._cols = target_col + padding + 1
+        self.num_states = self._rows * self._cols * 3
+        self._risk_levels = [cave.risk_level(row, col)
+                             for row in range(self._rows)
+                             for col in range(self._cols)]
+
+    def encode(self, position):
+        """ Packs a position into an integer state """
+        return (position.row * self._cols + position.col) * 3 + position.tool
+
+    def decode(self, state):
+        """ Unpacks an integer state into a position """
+        cell, tool = divmod(state, 3)
+        row, col = divmod(cell, self._cols)
+        return Position(row, col, self._risk_levels[cell], tool)
+
+    def neighbors(self, state):
+        """ Returns the valid neighbors of a state """
+        cell, tool = divmod(state, 3)
+        row, col = divmod(cell, self._cols)
+        neighbors = [cell * 3 + other_tool(self._risk_levels[cell], tool)]
+        if row > 0 and tool in TOOLS[self._risk_levels[cell - self._cols]]:
+            neighbors.append(state - self._cols * 3)
+
+        if col > 0 and tool in TOOLS[self._risk_levels[cell - 1]]:
+            neighbors.append(state - 3)
+
+        if col + 1 < self._cols and tool in TOOLS[self._risk_levels[cell + 1]]:
+            neighbors.append(state + 3)
+
+        if row + 1 < self._rows and tool in TOOLS[self._risk_levels[cell + self._cols]]:
+            neighbors.append(state + self._cols * 3)
+
+        return neighbors
+
+    @staticmethod
+    def distance_between(state0, state1):
+        """ Computes the distance between two states """
+        if state0 % 3 != state1 % 3:
+            return TOOL_SWITCH
+
+        return 1
+
+    def heuristic(self, state, goal):
+        """ The A* heuristic """
+        row, col = divmod(state // 3, self._cols)
+        goal_row, goal_col = divmod(goal // 3, self._cols)
+        return abs(row - goal_row) + abs(col - goal_col)
+
+    def find_shortest_path(self, start, goal, queue_type=BucketQueue, callback=None):
+        """ Finds the shortest path between two positions """
+        search = AStarSearch(self.heuristic, self.distance_between, self, queue_type,
+                             consistent=True, callback=callback, num_states=self.num_states)
+        goal = self.encode(goal)
+        path = search.find_shortest_path(self.encode(start), goal)
+        return [self.decode(state) for state in path]
+
+    def required_padding(self, path):
+        """ The padding needed to prove that the path to the target is the shortest """
+        time = sum(distance_between(a, b) for a, b in zip(path, path[1:]))
+        row, col = self._target
+        return max(0, (time - row - col - 1) // 2)
+
+
 def to_string(cave, target, rows, cols):
     """ Converts the cave to a string """
     risk_level = np.zeros((rows, cols), np.uint8)
@@ -188,14 +290,19 @@ def test_day22():
     assert actual == expected, "{} != {}".format(actual, expected)
 
     expected = 45
-    path = cave.find_shortest_path()
-    actual = 0
-    current = path[0]
-    for pos in path[1:]:
-        actual += distance_between(current, pos)
-        current = pos
+    for queue_type, bidirectional, packed in [(PriorityQueue, False, False),
+                                              (BucketQueue, False, False),
+                                              (PriorityQueue, True, False),
+                                              (BucketQueue, True, False),
+                                              (BucketQueue, False, True)]:
+        path = cave.find_shortest_path(queue_type, bidirectional, packed=packed)
+        actual = 0
+        current = path[0]
+        for pos in path[1:]:
+            actual += distance_between(current, pos)
+            current = pos
 
-    assert actual == expected, "{} != {}".format(actual, expected)
+        assert actual == expected, "{} != {}".format(actual, expected)
 
 
 def part1():
@@ -205,11 +312,11 @@ def part1():
     return cave.compute_total_risk()
 
 
-def part2():
+def part2(queue_type=BucketQueue, bidirectional=False, callback=None, packed=False):
     """ Solution to part 2 """
     depth, (col, row) = INPUT
     cave = Cave(depth, (row, col))
-    path = cave.find_shortest_path()
+    path = cave.find_shortest_path(queue_type, bidirectional, callback, packed)
     time = 0
     current = path[0]
     for pos in path[1:]:
@@ -219,9 +326,21 @@ def part2():
     return time
 
 
+def benchmark_queues():
+    """ Compares the priority queues on part 2 """
+    for queue_type in (LazyPriorityQueue, PriorityQueue, BucketQueue):
+        benchmark(queue_type.__name__, part2, queue_type, False, print)
+
+    benchmark("BidirectionalSearch", part2, PriorityQueue, True, print)
+    benchmark("PackedCave", part2, BucketQueue, False, print, True)
+
+
 def day22():
     """ Solution to day 22 """
-    parse_args()
+    args = parse_args()
+    if args.benchmark:
+        benchmark_queues()
+        return
 
     print("Part 1")
     print(part1())
@@ -3,7 +3,11 @@
 import logging
 from collections import namedtuple
 
-from utils import read_input, parse_args, diff, PriorityQueue
+import numpy as np
+
+from utils import read_input, parse_args, diff, benchmark
+from queues import PriorityQueue, LazyPriorityQueue
+from clique import MaxClique
 
 
 def range_dist(value, min_val, max_val):
@@ -140,7 +144,7 @@ def num_bots_for_point(point, nanobots):
     return num_bots
 
 
-def find_max_point(nanobots):
+def find_max_point(nanobots, queue_type=LazyPriorityQueue):
     """ Finds the maximum overlapping point """
     min_dim = nanobots[0].min
     max_dim = min_dim
@@ -158,7 +162,7 @@ def find_max_point(nanobots):
     num_bots = num_bots_for_cube(cube, nanobots)
     assert num_bots == len(nanobots)
 
-    queue = PriorityQueue()
+    queue = queue_type()
     queue.add(cube, (-num_bots, cube.distance))
 
     while queue:
@@ -178,6 +182,19 @@ def find_max_point(nanobots):
             queue.add(part, priority)
 
 
+def overlap_graph(nanobots):
+    """ The adjacency matrix of which nanobots have overlapping ranges """
+    positions = np.array([nanobot[:3] for nanobot in nanobots], np.int64)
+    radii = np.array([nanobot.radius for nanobot in nanobots], np.int64)
+    distances = np.abs(positions[:, None, :] - positions[None, :, :]).sum(axis=2)
+    return distances <= radii[:, None] + radii[None, :]
+
+
+def find_overlapping(nanobots):
+    """ Finds the largest sets of nanobots whose ranges all overlap pairwise """
+    return MaxClique(overlap_graph(nanobots)).find()
+
+
 def test_day23():
     """ Test for day 23 """
     nanobots = read_nanobots(read_input(23, True))
@@ -197,6 +214,9 @@ def test_day23():
 
     assert actual.length == actual.x + actual.y + actual.z
 
+    overlapping = find_overlapping(nanobots)
+    assert all(len(clique) >= num_bots_for_point(actual, nanobots) for clique in overlapping)
+
 
 def part1(nanobots):
     """ Solution to part 1 """
@@ -212,17 +232,28 @@ def part1(nanobots):
     return max_in_range
 
 
-def part2(nanobots):
+def part2(nanobots, queue_type=LazyPriorityQueue):
     """ Solution to part 2 """
-    point = find_max_point(nanobots)
+    point = find_max_point(nanobots, queue_type)
     return point.distance
 
 
+def benchmark_queues(nanobots):
+    """ Compares the priority queues on part 2 """
+    for queue_type in (LazyPriorityQueue, PriorityQueue):
+        benchmark(queue_type.__name__, part2, nanobots, queue_type)
+
+    benchmark("MaxClique", find_overlapping, nanobots)
+
+
 def day23():
     """ Solution to day 23 """
-    parse_args()
+    args = parse_args()
 
     nanobots = read_nanobots(read_input(23))
+    if args.benchmark:
+        benchmark_queues(nanobots)
+        return
 
     print("Part 1")
     print(part1(nanobots))
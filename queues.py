@@ -0,0 +1,319 @@
+""" Priority queues """
+
+import heapq
+import itertools
+import random
+from collections import deque
+
+import pytest
+
+
+class PriorityQueue:
+    """ Priority queue implemented as an indexed d-ary heap.
+
+    The heap holds (priority, count, value) entries, and the position of
+    every value is tracked so that updating its priority moves the entry in
+    place. Values with equal priority are popped in the order they were
+    added (or last updated). If `size` is given, values must be integers in
+    [0, size) and their positions are tracked in a list instead of a dictionary.
+    """
+
+    def __init__(self, arity=4, size=None):
+        self._arity = arity
+        self._heap = []
+        self._sized = size is not None
+        self._positions = [None] * size if self._sized else {}
+        self._lookup = self._positions.__getitem__ if self._sized else self._positions.get
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, value):
+        return self._lookup(value) is not None
+
+    @property
+    def stale_pops(self):
+        """ The number of outdated entries skipped, always 0 as entries are updated in place """
+        return 0
+
+    def add(self, value, priority=0):
+        """ Add a new value or update the priority of an existing value """
+        entry = (priority, next(self._counter), value)
+        index = self._lookup(value)
+        if index is None:
+            self._heap.append(entry)
+            self._sift_up(len(self._heap) - 1, entry)
+        elif entry < self._heap[index]:
+            self._sift_up(index, entry)
+        else:
+            self._sift_down(index, entry)
+
+    def pop(self):
+        """Remove and return the lowest priority task. Raise KeyError if empty."""
+        heap = self._heap
+        if not heap:
+            raise KeyError('pop from an empty priority queue')
+
+        priority, _, value = heap[0]
+        if self._sized:
+            self._positions[value] = None
+        else:
+            del self._positions[value]
+
+        last = heap.pop()
+        if heap:
+            self._sift_down(0, last)
+
+        return priority, value
+
+    def peek(self):
+        """Return the lowest priority task without removing it. Raise KeyError if empty."""
+        if not self._heap:
+            raise KeyError('peek at an empty priority queue')
+
+        priority, _, value = self._heap[0]
+        return priority, value
+
+    def _sift_up(self, index, entry):
+        """ Moves the entry up from the index to its place in the heap """
+        heap, positions, arity = self._heap, self._positions, self._arity
+        while index > 0:
+            parent = (index - 1) // arity
+            parent_entry = heap[parent]
+            if not entry < parent_entry:
+                break
+
+            heap[index] = parent_entry
+            positions[parent_entry[2]] = index
+            index = parent
+
+        heap[index] = entry
+        positions[entry[2]] = index
+
+    def _sift_down(self, index, entry):
+        """ Moves the entry down from the index to its place in the heap """
+        heap, positions, arity = self._heap, self._positions, self._arity
+        size = len(heap)
+        first = index * arity + 1
+        while first < size:
+            child = first
+            child_entry = heap[first]
+            for other in range(first + 1, min(first + arity, size)):
+                if heap[other] < child_entry:
+                    child = other
+                    child_entry = heap[other]
+
+            if not child_entry < entry:
+                break
+
+            heap[index] = child_entry
+            positions[child_entry[2]] = index
+            index = child
+            first = index * arity + 1
+
+        heap[index] = entry
+        positions[entry[2]] = index
+
+
+class BucketQueue:
+    """ Priority queue for monotone, small non-negative integer priorities.
+
+    Values are kept in a FIFO bucket per priority, and popping scans forward
+    from the last popped priority, so both operations are O(1) amortised.
+    Priorities may not be lower than the last popped priority. If `size` is
+    given, values must be integers in [0, size) (e.g. flat state indices)
+    and are tracked in a list instead of a dictionary.
+    """
+
+    def __init__(self, size=None):
+        self._size = size
+        self._entries = {} if size is None else [None] * size
+        self._buckets = []
+        self._cursor = 0
+        self._count = 0
+        self._stale_pops = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, value):
+        return self._lookup(value) is not None
+
+    @property
+    def stale_pops(self):
+        """ The number of outdated entries skipped """
+        return self._stale_pops
+
+    def _lookup(self, value):
+        if self._size is None:
+            return self._entries.get(value)
+
+        return self._entries[value]
+
+    def add(self, value, priority=0):
+        """ Add a new value or update the priority of an existing value """
+        if priority < self._cursor:
+            raise ValueError("priority {} is lower than the last popped priority {}".format(
+                priority, self._cursor))
+
+        entry = self._lookup(value)
+        if entry is None:
+            self._count += 1
+        else:
+            entry[1] = False
+
+        entry = [value, True]
+        self._entries[value] = entry
+        while len(self._buckets) <= priority:
+            self._buckets.append(deque())
+
+        self._buckets[priority].append(entry)
+
+    def pop(self):
+        """Remove and return the lowest priority task. Raise KeyError if empty."""
+        buckets = self._buckets
+        while self._cursor < len(buckets):
+            bucket = buckets[self._cursor]
+            while bucket:
+                value, alive = bucket.popleft()
+                if alive:
+                    self._entries[value] = None
+                    if self._size is None:
+                        del self._entries[value]
+
+                    self._count -= 1
+                    return self._cursor, value
+
+                self._stale_pops += 1
+
+            self._cursor += 1
+
+        raise KeyError('pop from an empty priority queue')
+
+    def peek(self):
+        """Return the lowest priority task without removing it. Raise KeyError if empty."""
+        buckets = self._buckets
+        while self._cursor < len(buckets):
+            bucket = buckets[self._cursor]
+            while bucket:
+                value, alive = bucket[0]
+                if alive:
+                    return self._cursor, value
+
+                bucket.popleft()
+                self._stale_pops += 1
+
+            self._cursor += 1
+
+        raise KeyError('peek at an empty priority queue')
+
+
+class LazyPriorityQueue:
+    """ Priority queue which marks updated entries as removed instead of moving them.
+
+    `size` is accepted so that it can stand in for the other queues, but
+    values are always tracked in a dictionary.
+    """
+    REMOVED = '<removed-value>'
+
+    def __init__(self, size=None):  # pylint: disable=W0613
+        self._entries = []
+        self._entry_finder = {}
+        self._counter = itertools.count()
+        self._stale_pops = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, value):
+        return value in self._entry_finder
+
+    @property
+    def stale_pops(self):
+        """ The number of removed entries skipped """
+        return self._stale_pops
+
+    def add(self, value, priority=0):
+        """ Add a new value or update the priority of an existing value """
+        if value in self._entry_finder:
+            self._remove_value(value)
+
+        count = next(self._counter)
+        entry = [priority, count, value]
+        self._entry_finder[value] = entry
+        heapq.heappush(self._entries, entry)
+
+    def _remove_value(self, value):
+        """Mark an existing task as REMOVED.  Raise KeyError if not found."""
+        entry = self._entry_finder.pop(value)
+        entry[-1] = LazyPriorityQueue.REMOVED
+
+    def pop(self):
+        """Remove and return the lowest priority task. Raise KeyError if empty."""
+        while self._entries:
+            priority, _, value = heapq.heappop(self._entries)
+            if value is not LazyPriorityQueue.REMOVED:
+                del self._entry_finder[value]
+                return priority, value
+
+            self._stale_pops += 1
+        raise KeyError('pop from an empty priority queue')
+
+    def peek(self):
+        """Return the lowest priority task without removing it. Raise KeyError if empty."""
+        while self._entries:
+            priority, _, value = self._entries[0]
+            if value is not LazyPriorityQueue.REMOVED:
+                return priority, value
+
+            heapq.heappop(self._entries)
+            self._stale_pops += 1
+        raise KeyError('peek at an empty priority queue')
+
+
+@pytest.mark.parametrize("size", [None, 500])
+def test_bucket_queue(size):
+    """ The bucket queue should pop in the same order as the priority queue
+    while priorities are monotone """
+    rng = random.Random(2018)
+    expected = PriorityQueue()
+    actual = BucketQueue(size)
+    last = 0
+    for _ in range(5000):
+        if rng.random() < 0.3 and actual:
+            last, value = actual.pop()
+            assert (last, value) == expected.pop()
+        else:
+            value = rng.randrange(500)
+            priority = last + rng.randrange(10)
+            expected.add(value, priority)
+            actual.add(value, priority)
+
+        assert (value in actual) == (value in expected)
+        assert len(actual) == len(expected)
+
+    while actual:
+        assert actual.pop() == expected.pop()
+
+
+@pytest.mark.parametrize("size", [None, 500])
+def test_priority_queue(size):
+    """ The indexed heap should pop in the same order as the lazy queue """
+    rng = random.Random(2018)
+    expected = LazyPriorityQueue()
+    actual = PriorityQueue(size=size)
+    for _ in range(5000):
+        if rng.random() < 0.3 and actual:
+            assert actual.pop() == expected.pop()
+        else:
+            value = rng.randrange(500)
+            priority = rng.randrange(100)
+            expected.add(value, priority)
+            actual.add(value, priority)
+
+        assert (value in actual) == (value in expected)
+
+    assert len(actual) == len(expected._entry_finder)  # pylint: disable=W0212
+    while actual:
+        assert actual.pop() == expected.pop()
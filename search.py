@@ -0,0 +1,567 @@
+""" Graph searches """
+
+import sys
+import logging
+import random
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+import pytest
+
+from queues import PriorityQueue, LazyPriorityQueue, BucketQueue
+
+
+class SearchStats:
+    """ Statistics about a search
+
+    The `*_container_bytes` fields are `sys.getsizeof` of the search maps.
+    For dictionaries that is only the hash table, not the keys and values it
+    refers to; for NumPy arrays it includes the data buffer. They are
+    therefore only comparable between searches using the same kind of map.
+    """
+
+    def __init__(self):
+        self.expansions = 0
+        self.pushes = 0
+        self.stale_pops = 0
+        self.peak_open_set = 0
+        self.g_scores_container_bytes = 0
+        self.came_from_container_bytes = 0
+        self.wall_time = 0
+
+    def record_push(self, open_set_size):
+        """ Records a push onto an open set of the given size """
+        self.pushes += 1
+        if open_set_size > self.peak_open_set:
+            self.peak_open_set = open_set_size
+
+    def record_memory(self, g_scores, came_from):
+        """ Records the container sizes of the search maps, which only grow """
+        self.g_scores_container_bytes += sys.getsizeof(g_scores)
+        self.came_from_container_bytes += sys.getsizeof(came_from)
+
+    def __repr__(self):
+        return ("SearchStats(expansions={}, pushes={}, stale_pops={}, peak_open_set={}, "
+                "g_scores_container_bytes={}, came_from_container_bytes={}, "
+                "wall_time={:.3f})").format(
+                    self.expansions, self.pushes, self.stale_pops, self.peak_open_set,
+                    self.g_scores_container_bytes, self.came_from_container_bytes,
+                    self.wall_time)
+
+
+class AStarSearch: #pylint: disable=R0902
+    """ Implementation of A* Search
+
+    If the heuristic is consistent (h(a) <= d(a, b) + h(b)), `consistent`
+    can be set so that expanded nodes are closed and never reopened.
+    Otherwise a node is reopened whenever a cheaper path to it is found.
+    The statistics of the last search are available from `stats`, and are
+    passed to `callback` (if provided) at the end of every search.
+
+    If the graph encodes its states as integers in [0, num_states), pass
+    `num_states` and the g scores, parents and closed set are kept in flat
+    NumPy arrays indexed by state instead of in dictionaries, and the queue
+    is created with `queue_type(size=num_states)`. The distances must then
+    be integers.
+    """
+
+    def __init__(self, heuristic, distance_between, graph, #pylint: disable=R0913
+                 queue_type=None, consistent=False, callback=None, num_states=None):
+        self._heuristic = heuristic
+        self._distance_between = distance_between
+        self._graph = graph
+        self._queue_type = queue_type or PriorityQueue
+        self._consistent = consistent
+        self._callback = callback
+        self._num_states = num_states
+        self._stats = SearchStats()
+
+    @property
+    def stats(self):
+        """ The statistics of the last search """
+        return self._stats
+
+    @property
+    def num_expansions(self):
+        """ The number of nodes expanded by the last search """
+        return self._stats.expansions
+
+    @staticmethod
+    def _reconstruct_path(came_from, current):
+        """ Reconstructs a path for A* search """
+        total_path = [current]
+        while current in came_from:
+            current = came_from[current]
+            total_path.append(current)
+
+        return total_path
+
+    def find_shortest_path(self, start, goal):
+        """ Find the shortest path from the start to the goal """
+        self._stats = SearchStats()
+        start_time = time.perf_counter()
+        if self._num_states is None:
+            path = self._find_shortest_path(start, goal, self._stats)
+        else:
+            path = self._find_packed_path(start, goal, self._stats)
+
+        self._stats.wall_time = time.perf_counter() - start_time
+        if self._callback:
+            self._callback(self._stats)
+
+        return path
+
+    def _find_shortest_path(self, start, goal, stats):
+        closed_set = set()
+        open_set = self._queue_type()
+        open_set.add(start, self._heuristic(start, goal))
+        stats.record_push(len(open_set))
+        came_from = {}
+        g_scores = {}
+        g_scores[start] = 0
+        while open_set:
+            f_score, current = open_set.pop()
+            if self._consistent:
+                if current in closed_set:
+                    stats.stale_pops += 1
+                    continue
+
+                closed_set.add(current)
+
+            stats.expansions += 1
+            if stats.expansions % 100 == 0:
+                logging.debug("%d: |open_set|=%d current f score: %d",
+                              stats.expansions, len(open_set), f_score)
+
+            if current == goal:
+                stats.stale_pops += open_set.stale_pops
+                stats.record_memory(g_scores, came_from)
+                return AStarSearch._reconstruct_path(came_from, current)
+
+            current_g_score = g_scores[current]
+            for neighbor in self._graph.neighbors(current):
+                if neighbor in closed_set:
+                    continue
+
+                tentative_g_score = current_g_score + self._distance_between(current, neighbor)
+                if neighbor in g_scores and tentative_g_score >= g_scores[neighbor]:
+                    continue
+
+                came_from[neighbor] = current
+                g_scores[neighbor] = tentative_g_score
+
+                f_score = tentative_g_score + self._heuristic(neighbor, goal)
+                open_set.add(neighbor, f_score)
+                stats.record_push(len(open_set))
+
+        stats.stale_pops += open_set.stale_pops
+        stats.record_memory(g_scores, came_from)
+        return None
+
+    def _find_packed_path(self, start, goal, stats):
+        closed = np.zeros(self._num_states, bool)
+        g_scores = np.full(self._num_states, np.iinfo(np.int64).max, np.int64)
+        came_from = np.full(self._num_states, -1,
+                            np.int32 if self._num_states < 2**31 else np.int64)
+        open_set = self._queue_type(size=self._num_states)
+        open_set.add(start, self._heuristic(start, goal))
+        stats.record_push(len(open_set))
+        g_scores[start] = 0
+        while open_set:
+            f_score, current = open_set.pop()
+            if self._consistent:
+                if closed[current]:
+                    stats.stale_pops += 1
+                    continue
+
+                closed[current] = True
+
+            stats.expansions += 1
+            if stats.expansions % 100 == 0:
+                logging.debug("%d: |open_set|=%d current f score: %d",
+                              stats.expansions, len(open_set), f_score)
+
+            if current == goal:
+                stats.stale_pops += open_set.stale_pops
+                stats.record_memory(g_scores, came_from)
+                total_path = [current]
+                while current != start:
+                    current = int(came_from[current])
+                    total_path.append(current)
+
+                return total_path
+
+            current_g_score = int(g_scores[current])
+            for neighbor in self._graph.neighbors(current):
+                if closed[neighbor]:
+                    continue
+
+                tentative_g_score = current_g_score + self._distance_between(current, neighbor)
+                if tentative_g_score >= g_scores[neighbor]:
+                    continue
+
+                came_from[neighbor] = current
+                g_scores[neighbor] = tentative_g_score
+
+                f_score = tentative_g_score + self._heuristic(neighbor, goal)
+                open_set.add(neighbor, f_score)
+                stats.record_push(len(open_set))
+
+        stats.stale_pops += open_set.stale_pops
+        stats.record_memory(g_scores, came_from)
+        return None
+
+
+class BidirectionalSearch:
+    """ Bidirectional A* (or Dijkstra, if there is no heuristic) Search
+
+    The graph provides `neighbors(node)` and, if edges are not symmetric,
+    `reverse_neighbors(node)` returning the nodes with an edge to `node`.
+    The heuristic must be consistent and symmetric, as both searches use
+    the average potential (h(node, goal) - h(node, start)) / 2. To keep the
+    queue keys integers (as `BucketQueue` requires), the potential is left
+    undivided and the g scores are doubled in the keys instead.
+    Statistics are reported as for `AStarSearch`, summed over both directions.
+    """
+
+    def __init__(self, heuristic, distance_between, graph, queue_type=None, callback=None):
+        self._heuristic = heuristic
+        self._distance_between = distance_between
+        self._graph = graph
+        self._queue_type = queue_type or PriorityQueue
+        self._callback = callback
+        self._stats = SearchStats()
+
+    @property
+    def stats(self):
+        """ The statistics of the last search """
+        return self._stats
+
+    @property
+    def num_expansions(self):
+        """ The number of nodes expanded by the last search """
+        return self._stats.expansions
+
+    def _reverse_neighbors(self, node):
+        if hasattr(self._graph, "reverse_neighbors"):
+            return self._graph.reverse_neighbors(node)
+
+        return self._graph.neighbors(node)
+
+    def find_shortest_path(self, start, goal):
+        """ Find the shortest path from the start to the goal """
+        self._stats = SearchStats()
+        start_time = time.perf_counter()
+        path = self._find_shortest_path(start, goal, self._stats)
+        self._stats.wall_time = time.perf_counter() - start_time
+        if self._callback:
+            self._callback(self._stats)
+
+        return path
+
+    def _create_frontiers(self, start, goal, stats):
+        """ The forward and backward frontiers and the offset of their summed keys """
+        if self._heuristic is None:
+            potential = lambda node: 0
+        else:
+            potential = lambda node: self._heuristic(node, goal) - self._heuristic(node, start)
+
+        # keys are twice the distances in the graph with edge costs reduced by the potential
+        forward = _SearchFrontier(start, lambda node: potential(node) - potential(start),
+                                  self._graph.neighbors,
+                                  self._distance_between, self._queue_type, stats)
+        backward = _SearchFrontier(goal, lambda node: potential(goal) - potential(node),
+                                   self._reverse_neighbors,
+                                   lambda a, b: self._distance_between(b, a), self._queue_type,
+                                   stats)
+        return forward, backward, potential(goal) - potential(start)
+
+    def _find_shortest_path(self, start, goal, stats):
+        forward, backward, offset = self._create_frontiers(start, goal, stats)
+        best = None
+        meeting = None
+        while forward.open_set and backward.open_set:
+            min_keys = forward.open_set.peek()[0] + backward.open_set.peek()[0]
+            if best is not None and min_keys >= 2 * best + offset:
+                break
+
+            if len(forward.open_set) <= len(backward.open_set):
+                frontier, other = forward, backward
+            else:
+                frontier, other = backward, forward
+
+            stats.expansions += 1
+            for node, g_score in frontier.expand(len(other.open_set)):
+                if node in other.g_scores:
+                    total = g_score + other.g_scores[node]
+                    if best is None or total < best:
+                        best = total
+                        meeting = node
+
+        for frontier in (forward, backward):
+            stats.stale_pops += frontier.open_set.stale_pops
+            frontier.record_memory()
+
+        if meeting is None:
+            return None
+
+        return backward.path_to(meeting)[:0:-1] + forward.path_to(meeting)
+
+
+class _SearchFrontier:
+    """ One direction of a bidirectional search, keyed by 2 * g + potential """
+
+    def __init__(self, start, potential, neighbors, distance_between, queue_type, stats):
+        self._potential = potential
+        self._neighbors = neighbors
+        self._distance_between = distance_between
+        self._stats = stats
+        self.open_set = queue_type()
+        self.open_set.add(start, potential(start))
+        self._stats.record_push(len(self.open_set))
+        self.g_scores = {start: 0}
+        self._came_from = {}
+
+    def record_memory(self):
+        """ Adds the size of this frontier's maps to the statistics """
+        self._stats.record_memory(self.g_scores, self._came_from)
+
+    def expand(self, other_open_set_size):
+        """ Expands the best open node, yielding the nodes whose g score improved.
+
+        As the potential is consistent, the g score of an expanded node is final
+        and the g score check alone keeps it closed.
+        """
+        _, current = self.open_set.pop()
+        yield current, self.g_scores[current]
+        for neighbor in self._neighbors(current):
+            g_score = self.g_scores[current] + self._distance_between(current, neighbor)
+            if neighbor in self.g_scores and g_score >= self.g_scores[neighbor]:
+                continue
+
+            self._came_from[neighbor] = current
+            self.g_scores[neighbor] = g_score
+            self.open_set.add(neighbor, 2 * g_score + self._potential(neighbor))
+            self._stats.record_push(len(self.open_set) + other_open_set_size)
+            yield neighbor, g_score
+
+    def path_to(self, node):
+        """ The path from the node back to the start of this frontier """
+        return AStarSearch._reconstruct_path(self._came_from, node)  # pylint: disable=W0212
+
+
+GridDistances = namedtuple("GridDistances", ("distances", "parents", "first_steps"))
+
+
+def _min_per_cell(cells, values):
+    """ The unique cells and the minimum value for each """
+    order = np.lexsort((values, cells))
+    cells = cells[order]
+    values = values[order]
+    first = np.ones(len(cells), bool)
+    first[1:] = cells[1:] != cells[:-1]
+    return cells[first], values[first]
+
+
+def _record_steps(cells, from_cells, parent_cells, first_cells):
+    """ Records the parent and the first step of newly reached cells.
+
+    Arrays which are not tracked are None. A cell reached from a source is its
+    own first step, and ties go to the lowest flat index.
+    """
+    if parent_cells is not None:
+        unique_cells, values = _min_per_cell(cells, from_cells)
+        parent_cells[unique_cells] = values
+
+    if first_cells is not None:
+        from_first = first_cells[from_cells]
+        unique_cells, values = _min_per_cell(cells, np.where(from_first >= 0, from_first, cells))
+        first_cells[unique_cells] = values
+
+
+def _unpad(values, shape):
+    """ Converts flat indices into the padded grid to flat indices into the grid """
+    rows, cols = shape
+    width = cols + 2
+    values = values.reshape(rows + 2, width)[1:-1, 1:-1]
+    return np.where(values >= 0, (values // width - 1) * cols + values % width - 1, -1)
+
+
+def grid_bfs(passable, sources, parents=False, first_steps=False):
+    """ Breadth-first search distances on a grid from one or more sources.
+
+    Moves are to the four manhattan neighbors which are passable (the sources
+    themselves need not be). The whole frontier is expanded at once with
+    NumPy. Returns a GridDistances with an int32 array of distances (-1 if
+    unreachable) and, if requested, arrays with the flat index of each cell's
+    parent and of the first step from the source on a shortest path (-1 for
+    sources and unreachable cells). Ties are broken in reading order.
+    """
+    width = passable.shape[1] + 2
+    padded = np.pad(passable, 1).ravel()
+    distances = np.full(padded.size, -1, np.int32)
+    parent_cells = np.full(padded.size, -1, np.int64) if parents else None
+    first_cells = np.full(padded.size, -1, np.int64) if first_steps else None
+    offsets = np.array([-width, -1, 1, width])
+
+    frontier = np.unique([(row + 1) * width + col + 1 for row, col in sources]).astype(np.int64)
+    distances[frontier] = 0
+    distance = 0
+    while len(frontier):
+        distance += 1
+        cells = (frontier[:, None] + offsets).ravel()
+        from_cells = np.repeat(frontier, len(offsets))
+        valid = padded[cells] & (distances[cells] == -1)
+        _record_steps(cells[valid], from_cells[valid], parent_cells, first_cells)
+        frontier = np.unique(cells[valid])
+        distances[frontier] = distance
+
+    return GridDistances(distances.reshape(-1, width)[1:-1, 1:-1],
+                         _unpad(parent_cells, passable.shape) if parents else None,
+                         _unpad(first_cells, passable.shape) if first_steps else None)
+
+
+class _WeightedGraph:
+    """ Small weighted graph for testing searches """
+
+    def __init__(self, edges):
+        self.edges = edges
+
+    def neighbors(self, node):
+        """ The nodes adjacent to the node """
+        return [end for start, end in self.edges if start == node]
+
+
+INCONSISTENT_EDGES = {("S", "A"): 1, ("A", "C"): 1, ("S", "B"): 1, ("B", "C"): 2, ("C", "G"): 3}
+INCONSISTENT_HEURISTIC = {"S": 0, "A": 4, "B": 0, "C": 0, "G": 0}
+
+
+@pytest.mark.parametrize("consistent, expected, expansions, pushes",
+                         [(False, 5, 6, 7), (True, 6, 5, 5)])
+def test_astar_reopening(consistent, expected, expansions, pushes):
+    """ Closed nodes must be reopened to find the shortest path when the
+    heuristic is inconsistent """
+    graph = _WeightedGraph(INCONSISTENT_EDGES)
+    distance = lambda a, b: INCONSISTENT_EDGES[(a, b)]
+    search = AStarSearch(lambda node, goal: INCONSISTENT_HEURISTIC[node],
+                         distance, graph, consistent=consistent)
+    path = search.find_shortest_path("S", "G")[::-1]
+    actual = sum(distance(a, b) for a, b in zip(path, path[1:]))
+    assert actual == expected
+    assert search.num_expansions == expansions
+
+    stats = []
+    search = AStarSearch(lambda node, goal: INCONSISTENT_HEURISTIC[node],
+                         distance, graph, LazyPriorityQueue, consistent, stats.append)
+    search.find_shortest_path("S", "G")
+    assert stats == [search.stats]
+    assert search.stats.expansions == expansions
+    assert search.stats.pushes == pushes
+    assert search.stats.peak_open_set == 2
+    assert search.stats.g_scores_container_bytes > 0
+
+
+class _DirectedGraph(_WeightedGraph):
+    """ Small weighted graph with a reverse neighbor hook """
+
+    def reverse_neighbors(self, node):
+        """ The nodes with an edge to the node """
+        return [start for start, end in self.edges if end == node]
+
+
+def test_bidirectional_search():
+    """ Bidirectional search should find paths as short as A* """
+    rng = random.Random(2018)
+    edges = {}
+    for _ in range(300):
+        start, end = rng.randrange(60), rng.randrange(60)
+        if start != end:
+            edges[(start, end)] = rng.randrange(1, 10)
+
+    graph = _DirectedGraph(edges)
+    distance = lambda a, b: edges[(a, b)]
+    expected_search = AStarSearch(lambda node, goal: 0, distance, graph)
+    actual_search = BidirectionalSearch(None, distance, graph)
+    for goal in range(1, 60):
+        expected = expected_search.find_shortest_path(0, goal)
+        actual = actual_search.find_shortest_path(0, goal)
+        if expected is None:
+            assert actual is None
+            continue
+
+        assert actual[0] == goal and actual[-1] == 0
+        path_length = lambda path: sum(distance(b, a) for a, b in zip(path, path[1:]))
+        assert path_length(actual) == path_length(expected)
+
+
+class _PackedGrid:
+    """ Grid of passable cells whose states are flat cell indices """
+
+    def __init__(self, passable):
+        self.passable = passable
+        self.cols = passable.shape[1]
+
+    def neighbors(self, state):
+        """ The passable cells next to the cell """
+        row, col = divmod(state, self.cols)
+        for drow, dcol in [(-1, 0), (0, -1), (0, 1), (1, 0)]:
+            if 0 <= row + drow < self.passable.shape[0] and 0 <= col + dcol < self.cols \
+                    and self.passable[row + drow, col + dcol]:
+                yield state + drow * self.cols + dcol
+
+    def heuristic(self, state, goal):
+        """ Manhattan distance between two cells """
+        row, col = divmod(state, self.cols)
+        goal_row, goal_col = divmod(goal, self.cols)
+        return abs(row - goal_row) + abs(col - goal_col)
+
+
+@pytest.mark.parametrize("queue_type", [PriorityQueue, LazyPriorityQueue, BucketQueue])
+def test_astar_packed_states(queue_type):
+    """ Searches over packed states should build sized queues and find shortest paths """
+    rng = np.random.RandomState(2018)
+    passable = rng.random_sample((30, 40)) < 0.7
+    passable[0, 0] = True
+    grid = _PackedGrid(passable)
+    distances = grid_bfs(passable, [(0, 0)]).distances
+    search = AStarSearch(grid.heuristic, lambda a, b: 1, grid, queue_type, consistent=True,
+                         num_states=passable.size)
+    for goal in np.flatnonzero(distances.ravel() > 0)[::50].tolist():
+        path = search.find_shortest_path(0, goal)
+        assert len(path) - 1 == distances.ravel()[goal]
+        assert path[0] == goal and path[-1] == 0
+
+
+def test_grid_bfs():
+    """ Grid BFS should match a breadth-first search over a random maze """
+    rng = np.random.RandomState(2018)
+    passable = rng.random_sample((30, 40)) < 0.7
+    sources = [(0, 0), (17, 23)]
+    actual = grid_bfs(passable, sources, True, True)
+
+    expected = np.full(passable.shape, -1)
+    frontier = deque(sources)
+    for source in sources:
+        expected[source] = 0
+
+    while frontier:
+        row, col = frontier.popleft()
+        for drow, dcol in [(-1, 0), (0, -1), (0, 1), (1, 0)]:
+            neighbor = row + drow, col + dcol
+            if 0 <= neighbor[0] < 30 and 0 <= neighbor[1] < 40 \
+                    and passable[neighbor] and expected[neighbor] == -1:
+                expected[neighbor] = expected[row, col] + 1
+                frontier.append(neighbor)
+
+    assert (actual.distances == expected).all()
+    reachable = expected > 0
+    parents = actual.parents[reachable]
+    assert (expected.ravel()[parents] == expected[reachable] - 1).all()
+    first_steps = actual.first_steps[reachable]
+    assert (expected.ravel()[first_steps] == 1).all()
+
+    passable = np.ones((3, 3), bool)
+    actual = grid_bfs(passable, [(0, 0)], first_steps=True)
+    assert actual.first_steps[2, 2] == 1
+    assert actual.first_steps[1, 0] == 3
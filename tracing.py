@@ -0,0 +1,151 @@
+""" Execution traces and profiles of Elf CPU programs """
+
+import numpy as np
+
+from utils import temp_file
+
+
+class Profile:
+    """ Execution counts per instruction of a program """
+
+    def __init__(self, program, ip_counts):
+        self._program = program
+        self._ip_counts = np.array(ip_counts, np.int64)
+
+    @property
+    def ip_counts(self):
+        """ The number of times each instruction was executed """
+        return self._ip_counts
+
+    @property
+    def num_steps(self):
+        """ The total number of instructions executed """
+        return int(self._ip_counts.sum())
+
+    @property
+    def op_counts(self):
+        """ The number of times each op code in the program was executed """
+        counts = {}
+        for inst, count in zip(self._program, self._ip_counts.tolist()):
+            if inst.op_code != "#ip":
+                counts[inst.op_code] = counts.get(inst.op_code, 0) + count
+
+        return counts
+
+    def listing(self):
+        """ The program annotated with execution counts and percentages """
+        total = max(self.num_steps, 1)
+        lines = ["{:>4} {:>12} {:>7}  {}".format("ip", "hits", "%", "instruction")]
+        for pointer, (inst, count) in enumerate(zip(self._program, self._ip_counts.tolist())):
+            lines.append("{:>4} {:>12} {:>7.2f}  {}".format(
+                pointer, count, 100 * count / total, inst))
+
+        lines.append("")
+        lines.append("{:>4} {:>12} {:>7}".format("op", "hits", "%"))
+        op_counts = self.op_counts
+        for op_code in sorted(op_counts, key=op_counts.get, reverse=True):
+            count = op_counts[op_code]
+            if count:
+                lines.append("{} {:>12} {:>7.2f}".format(op_code, count, 100 * count / total))
+
+        return "\n".join(lines)
+
+    def dump(self, path="profile.txt"):
+        """ Writes the annotated listing to the temporary directory """
+        path = temp_file(path)
+        with open(path, "w") as file:
+            file.write(self.listing())
+
+        return path
+
+
+def trace_dtype(num_registers=6):
+    """ The structured dtype for one step of a trace """
+    return np.dtype([("ip", np.int64), ("registers", np.int64, (num_registers,))])
+
+
+class TraceBuffer:
+    """ Fixed capacity ring buffer of (ip, registers) trace entries.
+
+    Entries are collected in a small flat list and flushed into a preallocated
+    NumPy array (or memory-mapped file, if a path is given) in chunks.
+    Once full, the oldest entries are overwritten.
+    """
+
+    def __init__(self, capacity=1 << 20, num_registers=6, path=None, chunk_size=4096):
+        self._dtype = trace_dtype(num_registers)
+        if path:
+            self._buffer = np.memmap(path, self._dtype, "w+", shape=(capacity,))
+        else:
+            self._buffer = np.zeros(capacity, self._dtype)
+
+        self._buffer["ip"] = -1
+        self._pending = []
+        self._entry_size = num_registers + 1
+        self._chunk_size = min(chunk_size, capacity) * self._entry_size
+        self._count = 0
+
+    def __len__(self):
+        return min(self.num_steps, len(self._buffer))
+
+    @property
+    def num_steps(self):
+        """ The total number of steps traced, including those overwritten """
+        return self._count + len(self._pending) // self._entry_size
+
+    def append(self, entry):
+        """ Appends an (ip, registers) entry to the trace """
+        pending = self._pending
+        pending.append(entry[0])
+        pending.extend(entry[1])
+        if len(pending) == self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes the pending entries to the buffer """
+        if not self._pending:
+            return
+
+        chunk = np.array(self._pending, np.int64).view(self._dtype)
+        self._pending = []
+
+        capacity = len(self._buffer)
+        start = self._count % capacity
+        split = min(len(chunk), capacity - start)
+        self._buffer[start:start + split] = chunk[:split]
+        self._buffer[:len(chunk) - split] = chunk[split:]
+        self._count += len(chunk)
+
+    @property
+    def entries(self):
+        """ The traced entries, oldest first, as a structured array """
+        self.flush()
+        capacity = len(self._buffer)
+        if self._count <= capacity:
+            return self._buffer[:self._count]
+
+        head = self._count % capacity
+        return np.concatenate((self._buffer[head:], self._buffer[:head]))
+
+    def close(self):
+        """ Flushes the trace, leaving memory-mapped files in chronological order """
+        entries = self.entries
+        if isinstance(self._buffer, np.memmap):
+            if self._count > len(self._buffer):
+                self._buffer[:] = entries
+
+            self._buffer.flush()
+
+    def hot_ips(self):
+        """ The number of times each instruction pointer appears in the trace """
+        return np.bincount(self.entries["ip"])
+
+    def register_histogram(self, register, bins=10):
+        """ Histogram of the values of a register across the trace """
+        return np.histogram(self.entries["registers"][:, register], bins)
+
+
+def read_trace(path, num_registers=6):
+    """ Reads a trace written by a memory-mapped TraceBuffer """
+    entries = np.memmap(path, trace_dtype(num_registers), "r")
+    return entries[entries["ip"] >= 0]
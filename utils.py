@@ -2,9 +2,8 @@
 
 import os
 import argparse
-import itertools
 import logging
-import heapq
+import time
 from collections import deque
 from subprocess import Popen, PIPE, STDOUT
 
@@ -45,6 +44,8 @@ def parse_args():
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--video", action="store_true")
     parser.add_argument("--num_video_frames", type=int, default=0)
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--processes", type=int)
     args = parser.parse_args()
 
     if args.verbose:
@@ -187,6 +188,14 @@ class Point:
         return Point(self._row + other.row, self._col + other.col)
 
 
+def benchmark(name, function, *args):
+    """ Calls the function, printing how long it took """
+    start = time.perf_counter()
+    result = function(*args)
+    print("{}: {:.3f}s".format(name, time.perf_counter() - start))
+    return result
+
+
 def assert_equal(actual, expected):
     """ Assert the two values are equal, and print an appropriate error message """
     if isinstance(actual, str):
@@ -225,180 +234,66 @@ def diff(actual, expected):
     return "\n".join(["".join(line) for line in result])
 
 
-class AStarSearch:
-    """ Implementation of A* Search """
-
-    def __init__(self, heuristic, distance_between, graph):
-        self._heuristic = heuristic
-        self._distance_between = distance_between
-        self._graph = graph
-
-    @staticmethod
-    def _reconstruct_path(came_from, current):
-        """ Reconstructs a path for A* search """
-        total_path = [current]
-        while current in came_from:
-            current = came_from[current]
-            total_path.append(current)
-
-        return total_path
-
-    def find_shortest_path(self, start, goal):
-        """ Find the shortest path from the start to the goal """
-        closed_set = set()
-        open_set = PriorityQueue()
-        open_set.add(start, self._heuristic(start, goal))
-        came_from = {}
-        g_scores = {}
-        g_scores[start] = 0
-        iteration = 0
-        while open_set:
-            f_score, current = open_set.pop()
-
-            iteration += 1
-            if iteration % 100 == 0:
-                logging.debug("%d: |open_set|=%d current f score: %d",
-                              iteration, len(open_set), f_score)
-
-            if current == goal:
-                return AStarSearch._reconstruct_path(came_from, current)
-
-            closed_set.add(current)
-
-            for neighbor in self._graph.neighbors(current):
-                if neighbor in closed_set:
-                    continue
-
-                tentative_g_score = g_scores[current]
-                tentative_g_score += self._distance_between(current, neighbor)
-                if neighbor in open_set:
-                    if tentative_g_score >= g_scores[neighbor]:
-                        continue
+class IntSet:
+    """ Insertion-ordered set of integers backed by NumPy arrays.
 
-                came_from[neighbor] = current
-                g_scores[neighbor] = tentative_g_score
+    Values are stored densely in insertion order, and an open-addressing
+    hash table with linear probing maps values to their position.
+    """
+    EMPTY = -1
 
-                f_score = g_scores[neighbor] + self._heuristic(neighbor, goal)
-                open_set.add(neighbor, f_score)
-
-        return None
-
-
-class MaxClique:
-    """ Find the maximum clique in a graph """
-
-    def __init__(self, edges, verbose):
-        self._edges = edges
-        self._current = []
-        self._max = []
-        self._max_size = 0
-        self._verbose = verbose
-
-    def _find_color_groups(self, nodes):
-        color_groups = []
-        for node in nodes:
-            adjacent = True
-            for color_group in color_groups:
-                if np.sum(self._edges[node][color_group]) == 0:
-                    color_group.append(node)
-                    adjacent = False
-                    break
-
-            if adjacent:
-                color_groups.append([node])
-
-        return color_groups
-
-    def _color_graph(self, nodes):
-        if self._verbose:
-            print("coloring graph of size", len(nodes))
-
-        color_groups = self._find_color_groups(nodes)
-        nodes = []
-        colors = []
-        for color, color_group in enumerate(color_groups):
-            nodes.extend(color_group)
-            colors.extend([color + 1] * len(color_group))
-
-        return nodes, colors
-
-    def find(self):
-        """ Finds the maximum clique """
-        nodes = list(range(self._edges.shape[0]))
-        self._max_clique(nodes)
-        return self._max
-
-    def _max_clique(self, nodes):
-        if self._verbose:
-            print("finding max clique for graph of size", len(nodes))
-
-        nodes, colors = self._color_graph(nodes)
-
-        while nodes:
-            node = nodes.pop()
-            color = colors.pop()
-            if self._verbose:
-                print("|Q| + C = ", len(self._current) +
-                      color, "|Qmax| = ", self._max_size)
-
-            if len(self._current) + color >= self._max_size:
-                self._current.append(node)
-                adjacent = []
-                for other in nodes:
-                    if self._edges[node, other]:
-                        adjacent.append(other)
-
-                if adjacent:
-                    self._max_clique(adjacent)
-                elif len(self._current) > self._max_size:
-                    self._max_size = len(self._current)
-                    self._max = [self._current.copy()]
-                elif len(self._current) == self._max_size:
-                    self._max.append(self._current.copy())
-
-                assert self._current.pop() == node
-            else:
-                return
-
-
-class PriorityQueue:
-    """ Implementation of a priority queue """
-    REMOVED = '<removed-value>'
-
-    def __init__(self):
-        self._entries = []
-        self._entry_finder = {}
-        self._counter = itertools.count()
+    def __init__(self, capacity=1024):
+        self._values = np.zeros(capacity, np.int64)
+        self._table = np.full(2*capacity, IntSet.EMPTY, np.int64)
+        self._mask = 2*capacity - 1
+        self._size = 0
+        assert capacity & (capacity - 1) == 0, "capacity must be a power of two"
 
     def __len__(self):
-        return len(self._entries)
+        return self._size
 
     def __contains__(self, value):
-        return value in self._entry_finder
-
-    def add(self, value, priority=0):
-        """ Add a new value or update the priority of an existing value """
-        if value in self._entry_finder:
-            self._remove_value(value)
-
-        count = next(self._counter)
-        entry = [priority, count, value]
-        self._entry_finder[value] = entry
-        heapq.heappush(self._entries, entry)
-
-    def _remove_value(self, value):
-        """Mark an existing task as REMOVED.  Raise KeyError if not found."""
-        entry = self._entry_finder.pop(value)
-        entry[-1] = PriorityQueue.REMOVED
-
-    def pop(self):
-        """Remove and return the lowest priority task. Raise KeyError if empty."""
-        while self._entries:
-            priority, _, value = heapq.heappop(self._entries)
-            if value is not PriorityQueue.REMOVED:
-                del self._entry_finder[value]
-                return priority, value
-        raise KeyError('pop from an empty priority queue')
+        return self._table[self._find(value)] != IntSet.EMPTY
+
+    def _find(self, value):
+        """ Returns the slot of the value in the table, or the empty slot where it belongs """
+        slot = (value * 0x9E3779B97F4A7C15 >> 16) & self._mask
+        while True:
+            index = self._table[slot]
+            if index == IntSet.EMPTY or self._values[index] == value:
+                return slot
+
+            slot = (slot + 1) & self._mask
+
+    def _grow(self):
+        capacity = 2 * len(self._values)
+        values = self._values
+        self._values = np.zeros(capacity, np.int64)
+        self._values[:self._size] = values[:self._size]
+        self._table = np.full(2*capacity, IntSet.EMPTY, np.int64)
+        self._mask = 2*capacity - 1
+        for index, value in enumerate(values[:self._size].tolist()):
+            self._table[self._find(value)] = index
+
+    def add(self, value):
+        """ Adds a value to the set, returning False if it was already present """
+        slot = self._find(value)
+        if self._table[slot] != IntSet.EMPTY:
+            return False
+
+        if self._size == len(self._values):
+            self._grow()
+            slot = self._find(value)
+
+        self._values[self._size] = value
+        self._table[slot] = self._size
+        self._size += 1
+        return True
+
+    @property
+    def values(self):
+        """ The values in the order they were added """
+        return self._values[:self._size].copy()
 
 
 class Tokenizer: